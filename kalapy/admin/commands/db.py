@@ -14,7 +14,7 @@ from kalapy import db
 from kalapy.admin import ActionCommand
 from kalapy.conf import settings
 from kalapy.conf.loader import loader
-from kalapy.db.engines import database
+from kalapy.db.engines import database, databases, get_database
 
 
 try:
@@ -59,7 +59,8 @@ class DBCommand(ActionCommand):
             loader.load()
             super(DBCommand, self).execute(options, args)
         finally:
-            database.close()
+            for conn in databases.values():
+                conn.close()
 
     def get_models(self, *packages):
         """Similar to `db.get_models` but returns a tuple, (list of models,
@@ -98,7 +99,7 @@ class DBCommand(ActionCommand):
             raise self.error('no package name provided.')
         models, pending = self.get_models(*packages)
         for model in models:
-            print_colorized(database.schema_table(model))
+            print_colorized(get_database(model).schema_table(model))
         if pending:
             print_colorized('\n-- the following tables should also be added (from other packages)\n')
             for model in pending:
@@ -107,19 +108,19 @@ class DBCommand(ActionCommand):
 
     def action_sync(self, options, args):
         """Create the database tables for all the INSTALLED_PACKAGES whose
-        tables haven't been created yet.
+        tables haven't been created yet, and the missing indexes.
         """
         models, __pending = self.get_models()
         try:
             for model in models:
                 if options.verbose:
                     print "Sync table %r" % (model._meta.table)
-                database.create_table(model)
+                get_database(model).create_table(model)
         except:
-            database.rollback()
+            db.rollback()
             raise
         else:
-            database.commit()
+            db.commit()
 
     def action_reset(self, options, args):
         """Reset the model tables. Use with care, will drop all the tables.
@@ -140,12 +141,12 @@ Are you sure about this action? (y/N): """ % settings.DATABASE_NAME)
             for model in models:
                 if options.verbose:
                     print "Drop table %r" % model._meta.table
-                database.drop_table(model)
+                get_database(model).drop_table(model)
         except:
-            database.rollback()
+            db.rollback()
             raise
         else:
-            database.commit()
+            db.commit()
 
         self.action_sync(options, args)
 
@@ -167,8 +168,8 @@ Are you sure about this action? (y/N): """ % settings.DATABASE_NAME)
                     print "Clear table %r" % model._meta.table
                 model.all().delete()
         except:
-            database.rollback()
+            db.rollback()
             raise
         else:
-            database.commit()
+            db.commit()
 
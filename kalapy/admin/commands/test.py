@@ -11,6 +11,7 @@ import os
 
 from kalapy.admin import Command, execute_command
 from kalapy.conf import settings
+from kalapy.db.engines import databases
 from kalapy.test import run_tests
 
 
@@ -44,11 +45,14 @@ class TestCommand(Command):
 
     def execute(self, options, args):
 
-        dbname = settings.DATABASE_NAME
-        if settings.DATABASE_ENGINE == 'sqlite3':
-            dbname = os.path.basename(dbname)
-        if dbname and not dbname.lower().startswith('test_'):
-            self.error("Invalid database %r, test database name must start with 'test_'" % dbname)
+        # the named databases and the replicas, with the inherited names
+        for conn in databases.values():
+            for params in [conn.params] + conn.replicas:
+                dbname = params.get('name')
+                if settings.DATABASE_ENGINE == 'sqlite3':
+                    dbname = os.path.basename(dbname or '')
+                if dbname and not dbname.lower().startswith('test_'):
+                    self.error("Invalid database %r, test database name must start with 'test_'" % dbname)
 
         args = args or self.packages_with_tests()
 
@@ -11,6 +11,23 @@ DATABASE_USER = ""
 DATABASE_PASSWORD = ""
 DATABASE_HOST = ""
 DATABASE_PORT = ""
+DATABASE_OPTIONS = {
+}
+
+# the replicas of the database, the queries read from them, e.g.
+# ({'HOST': 'replica1'}, {'HOST': 'replica2', 'PORT': '5433'})
+DATABASE_REPLICAS = (
+)
+
+# other databases by name, used by the models declared with __database__ or
+# by the packages with 'database' option, e.g.
+# {'logs': {'NAME': 'logs', 'HOST': 'logs.example.com'}}
+DATABASES = {
+}
+
+# requests with these methods run in read-only mode, e.g. ('GET', 'HEAD')
+DATABASE_READONLY_METHODS = (
+)
 
 USE_I18N = True
 
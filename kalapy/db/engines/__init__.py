@@ -15,9 +15,11 @@ from werkzeug.local import LocalStack
 
 from kalapy.conf import settings
 from kalapy.utils import signals
+from kalapy.db.engines import utils
 
 
-__all__ = ('Database', 'DatabaseError', 'IntegrityError', 'database')
+__all__ = ('Database', 'DatabaseError', 'IntegrityError', 'database',
+           'databases', 'get_database')
 
 
 if not settings.DATABASE_ENGINE:
@@ -35,70 +37,236 @@ DatabaseError = engine.DatabaseError
 IntegrityError = engine.IntegrityError
 
 
+class Context(object):
+    """The databases used by a context, see :class:`Connection`.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.replica = None
+        self.replica_index = None
+        self.sticky = False
+        self.transactions = 0
+
+
 class Connection(object):
+    """The context local database connection. The :class:`Database` of the
+    current context is created on first use, and the engines connect to the
+    database only when the first query is executed, so that the requests not
+    using the database don't open connections.
 
-    __ctx = LocalStack()
+    The queries can read from the replicas of the primary database, see
+    :meth:`reader`.
 
-    def __getattr__(self, name):
+    :param params: the connection parameters of the primary database
+    :param replicas: the connection parameters of the replicas, the missing
+                     parameters are the same as of the primary database
+    :param policy: the replica policy, see :class:`utils.Router`
+    :param sticky: whether to read from the primary database after a write
+    """
+
+    #: the methods writing to the database
+    writes = ('insert_records', 'update_records', 'delete_records',
+              'update_where', 'delete_where')
+
+    def __init__(self, params, replicas=(), policy='round_robin', sticky=True):
+        self.params = params
+        self.replicas = [dict(params, **replica) for replica in replicas]
+        self.router = utils.Router(len(self.replicas), policy) \
+                      if self.replicas else None
+        self.sticky = sticky
+        self.__ctx = LocalStack()
+
+    def __context(self):
         if self.__ctx.top is None:
-            self.connect()
-        return getattr(self.__ctx.top, name)
+            self.__ctx.push(Context(Database(**self.params)))
+        return self.__ctx.top
+
+    def __getattr__(self, name):
+        context = self.__context()
+        if name in self.writes and self.sticky:
+            context.sticky = True
+        return getattr(context.database, name)
+
+    @property
+    def is_active(self):
+        """Whether the database has been used in the current context.
+        """
+        return self.__ctx.top is not None
+
+    def reader(self):
+        """Return the database to read from. It's a replica chosen by the
+        router and kept for the rest of the context, or the primary database
+        if there are no replicas, inside :meth:`run_in_transaction` and after
+        a write in the current context (for read-your-writes consistency).
+        """
+        context = self.__context()
+        if self.router is None or context.sticky or context.transactions:
+            return context.database
+        if context.replica is None:
+            index = self.router.acquire()
+            try:
+                replica = Database(**self.replicas[index])
+                if context.database.readonly:
+                    replica.set_readonly(True)
+            except:
+                self.router.release(index)
+                raise
+            context.replica, context.replica_index = replica, index
+        return context.replica
 
     def connect(self):
-        if self.__ctx.top is None:
-            db = Database(
-                    name=settings.DATABASE_NAME,
-                    host=settings.DATABASE_HOST,
-                    port=settings.DATABASE_PORT,
-                    user=settings.DATABASE_USER,
-                    password=settings.DATABASE_PASSWORD)
-            self.__ctx.push(db)
-        self.__ctx.top.connect()
+        self.__context().database.connect()
 
     def close(self):
-        if self.__ctx.top is not None:
-            self.__ctx.top.close()
+        context = self.__ctx.top
+        if context is None:
+            return
+        try:
+            if context.replica is not None:
+                try:
+                    context.replica.close()
+                finally:
+                    self.router.release(context.replica_index)
+            context.database.close()
+        finally:
             self.__ctx.pop()
 
+    def commit(self):
+        context = self.__context()
+        context.database.commit()
+        if context.replica is not None:
+            context.replica.commit()
+
+    def rollback(self):
+        context = self.__context()
+        context.database.rollback()
+        if context.replica is not None:
+            context.replica.rollback()
+
+    def enter_transaction(self):
+        """Mark the start of a transaction in the current context, the queries
+        read from the primary database until :meth:`exit_transaction`.
+        """
+        self.__context().transactions += 1
+
+    def exit_transaction(self):
+        """Mark the end of a transaction in the current context.
+        """
+        self.__context().transactions -= 1
+
+    def run_in_transaction(self, func, *args, **kw):
+        database = self.__context().database
+        self.enter_transaction()
+        try:
+            return database.run_in_transaction(func, *args, **kw)
+        finally:
+            self.exit_transaction()
+
+
+def _params(options):
+    return dict([(k.lower(), v) for k, v in options.items()])
+
+
+def _connection(params, replicas):
+    return Connection(params, map(_params, replicas),
+        policy=settings.DATABASE_OPTIONS.get('replica_policy', 'round_robin'),
+        sticky=settings.DATABASE_OPTIONS.get('replica_sticky', True))
+
 
 #: context local database connection
-database = Connection()
+database = _connection(
+    dict(name=settings.DATABASE_NAME,
+         host=settings.DATABASE_HOST,
+         port=settings.DATABASE_PORT,
+         user=settings.DATABASE_USER,
+         password=settings.DATABASE_PASSWORD),
+    settings.DATABASE_REPLICAS)
+
+#: context local connections of the databases by name, the `default` database
+#: and the ones of ``settings.DATABASES``
+databases = {'default': database}
+
+for _name, _options in settings.DATABASES.items():
+    _options = dict(_options)
+    _replicas = _options.pop('REPLICAS', ())
+    databases[_name] = _connection(
+        dict(database.params, **_params(_options)), _replicas)
+
+
+def get_database(model):
+    """Return the context local connection of the database where the given
+    model is stored, see ``__database__`` model attribute.
+
+    :param model: a model class or instance
+    """
+    return databases[model._meta.database]
+
+
+def _active():
+    return [conn for conn in databases.values() if conn.is_active]
 
 
 def commit():
-    """Commit the changes to the database.
+    """Commit the changes to the databases used in the current context.
     """
-    database.commit()
+    for conn in _active():
+        conn.commit()
 
 
 def rollback():
-    """Rollback all the changes made since the last commit.
+    """Rollback all the changes made since the last commit to the databases
+    used in the current context.
     """
-    database.rollback()
+    for conn in _active():
+        conn.rollback()
 
 def run_in_transaction(func, *args, **kw):
-    """A helper function to run the specified func in a transaction.
+    """A helper function to run the specified func in a transaction. The
+    changes to the other databases are committed or rolled back along with
+    the default database. The queries of all the databases read from the
+    primary databases during the transaction.
     """
-    return database.run_in_transaction(func, *args, **kw)
+    conns = databases.values()
+    for conn in conns:
+        conn.enter_transaction()
+    try:
+        try:
+            res = database.run_in_transaction(func, *args, **kw)
+        except:
+            for conn in _active():
+                if conn is not database:
+                    conn.rollback()
+            raise
+        for conn in _active():
+            if conn is not database:
+                conn.commit()
+        return res
+    finally:
+        for conn in conns:
+            conn.exit_transaction()
 
-@signals.connect('request-started')
-def open_connection():
-    """Open database connection when request started.
+@signals.connect('request-finished')
+def close_connection():
+    """Close database connections when request ends, of the databases used
+    during the request.
     """
-    database.connect()
+    for conn in databases.values():
+        conn.close()
 
 
-@signals.connect('request-finished')
-def close_connection():
-    """Close database connection when request ends.
+@signals.connect('request-readonly')
+def readonly_connection():
+    """Switch the database connections to read-only mode for the requests
+    which don't write to the database.
     """
-    database.close()
+    for conn in databases.values():
+        conn.set_readonly(True)
 
 
 @signals.connect('request-exception')
 def rollback_connection(error):
-    """Rollback database connection, if there is any unhandled exception
+    """Rollback database connections, if there is any unhandled exception
     during request processing.
     """
-    database.rollback()
-
+    rollback()
@@ -7,7 +7,7 @@ Implementes Google AppEngine backend.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
-from itertools import chain
+from itertools import chain, islice
 
 try:
     from google.appengine.api import datastore
@@ -52,7 +52,7 @@ class Database(IDatabase):
         pass
 
     def rollback(self):
-        pass
+        self.identity_map.clear()
 
     def run_in_transaction(self, func, *args, **kw):
         return datastore.RunInTransaction(func, *args, **kw)
@@ -69,6 +69,10 @@ class Database(IDatabase):
     def create_table(self, model):
         pass
 
+    def create_indexes(self, model):
+        # the datastore indexes are managed with index.yaml
+        return []
+
     def alter_table(self, model, name=None):
         pass
 
@@ -78,6 +82,7 @@ class Database(IDatabase):
     def update_records(self, instance, *args):
 
         result = []
+        updates = []
         instances = [instance]
         instances.extend(args)
 
@@ -86,20 +91,58 @@ class Database(IDatabase):
                 raise TypeError('update_records expects Model instances')
             items = obj._to_database_values(True)
 
-            if not obj.is_saved:
+            # test unique contraints
+            if self.check_unique:
+                check_unique(obj, items)
+
+            if obj.is_saved:
+                # put the changed entities at once
+                obj._payload.update(items)
+                updates.append(obj)
+            else:
                 obj._payload = datastore.Entity(obj._meta.table)
+                obj._payload.update(items)
+                obj._key = str(datastore.Put(obj._payload))
+                obj.set_dirty(False)
+                self.identity_map.add(obj)
+
+            result.append(obj.key)
+
+        for i in range(0, len(updates), 500):
+            batch = updates[i:i+500]
+            datastore.Put([obj._payload for obj in batch])
+            # the entities are clean only once they are put
+            for obj in batch:
+                obj.set_dirty(False)
+
+        return result
+
+    def insert_records(self, instances, batch_size=None):
+
+        # the datastore accepts up to 500 entities per batch put
+        batch_size = min(batch_size or 500, 500)
+
+        for obj in instances:
+            if not isinstance(obj, Model):
+                raise TypeError('insert_records expects Model instances')
+            items = obj._to_database_values(True)
 
             # test unique contraints
             if self.check_unique:
                 check_unique(obj, items)
 
+            obj._payload = datastore.Entity(obj._meta.table)
             obj._payload.update(items)
-            obj._key = str(datastore.Put(obj._payload))
 
-            result.append(obj.key)
-            obj.set_dirty(False)
+        for i in range(0, len(instances), batch_size):
+            batch = instances[i:i+batch_size]
+            keys = datastore.Put([obj._payload for obj in batch])
+            for obj, key in zip(batch, keys):
+                obj._key = str(key)
+                obj.set_dirty(False)
+                self.identity_map.add(obj)
 
-        return result
+        return [obj.key for obj in instances]
 
     def delete_records(self, instance, *args):
 
@@ -117,29 +160,76 @@ class Database(IDatabase):
         keys = [obj.key for obj in instances]
         datastore.Delete(keys)
 
+        self.identity_map.discard(*instances)
         for obj in instances:
             obj._key = None
             obj.set_dirty(True)
 
         return keys
 
-    def fetch(self, qset, limit, offset):
-        limit = datastore.MAXIMUM_RESULTS if limit == -1 else limit
-        orderings = []
+    def update_where(self, qset, values):
+        if not values:
+            return 0
+
+        # test unique contraints
+        if self.check_unique:
+            check_unique(qset.model, values)
+
+        self.identity_map.clear(qset.model)
+
+        entities = [e['_payload'] for e in self.fetch(qset, -1, 0)]
+        for e in entities:
+            e.update(values)
+        if entities:
+            datastore.Put(entities)
+        return len(entities)
+
+    def delete_where(self, qset):
+        self.identity_map.clear(qset.model, related=True)
+        if self.check_reference:
+            # emulate cascades, record by record
+            instances = map(qset.model._from_database_values,
+                            self.fetch(qset, -1, 0))
+            if instances:
+                self.delete_records(*instances)
+            return len(instances)
+
+        keys = [e['_payload'].key() for e in self.fetch(qset, -1, 0)]
+        if keys:
+            datastore.Delete(keys)
+        return len(keys)
+
+    def fetch_record(self, model, key):
         try:
-            name, how = qset.order
-            how = Query.ASCENDING if how == 'ASC' else Query.DESCENDING
-            orderings = [(name, how)]
-        except:
-            pass
+            e = datastore.Get(key)
+        except (datastore_errors.EntityNotFoundError, datastore_errors.BadKeyError):
+            return None
+        if e.kind() != model._meta.table:
+            return None
+        return dict(e, key=str(e.key()), _payload=e)
+
+    def fetch(self, qset, limit, offset):
+        orderings = self._orderings(qset)
 
         keys = self._keys(qset)
         result = []
 
-        if keys: # if only key filter
-            result = [e for e in datastore.Get(keys) if e]
-        else: # else build query, the results should be ANDed
-            query_set = self._build_query_set(qset, orderings)
+        query_set = [] if keys else self._build_query_set(qset, orderings)
+        if len(query_set) == 1:
+            # single query, stream the results in batches from the datastore
+            stop = None if limit == -1 else offset + limit
+            for e in islice(query_set[0].Run(), offset, stop):
+                if e:
+                    yield dict(e, key=str(e.key()), _payload=e)
+            return
+
+        if keys: # if only key filter, get them in batches of allowed size
+            size = datastore.MAXIMUM_RESULTS
+            result = [e for i in range(0, len(keys), size) \
+                        for e in datastore.Get(keys[i:i + size]) if e]
+            limit = len(result) if limit == -1 else limit
+        else: # else run all the queries, the results should be ANDed
+            limit = datastore.MAXIMUM_RESULTS if limit == -1 else limit
             result_set = [[e for e in q.Get(limit, offset) if e] for q in query_set]
             keys = [set([e.key() for e in result]) for result in result_set]
             keys = reduce(lambda a, b: a & b, keys)
@@ -153,9 +243,34 @@ class Database(IDatabase):
         for e in sort_result(result, orderings)[:limit]:
             yield dict(e, key=str(e.key()), _payload=e)
 
+    def fetch_page(self, qset, limit, cursor=None):
+        orderings = self._orderings(qset)
+        query_set = [] if self._keys(qset) else \
+                    self._build_query_set(qset, orderings, cursor)
+        if len(query_set) != 1 or isinstance(query_set[0], MultiQuery):
+            raise DatabaseError(_('Cursors are not supported for this query.'))
+
+        q = query_set[0]
+        result = [dict(e, key=str(e.key()), _payload=e) for e in q.Get(limit) if e]
+        if len(result) < limit:
+            return result, None
+        # the cursor only if there is a next page
+        cursor = q.GetCursor()
+        if not self._build_query_set(qset, orderings, cursor)[0].Get(1):
+            return result, None
+        return result, cursor
+
     def count(self, qset):
         return len(list(self.fetch(qset, -1, 0)))
 
+    def _orderings(self, qset):
+        try:
+            name, how = qset.order
+        except:
+            return []
+        how = Query.ASCENDING if how == 'ASC' else Query.DESCENDING
+        return [(name, how)]
+
     def _keys(self, qset):
         if len(qset.items) == 1:
             q = qset.items[0]
@@ -166,7 +281,7 @@ class Database(IDatabase):
                 return keys
         return []
 
-    def _build_query_set(self, qset, orderings):
+    def _build_query_set(self, qset, orderings, cursor=None):
 
         kind = qset.model._meta.table
 
@@ -180,26 +295,42 @@ class Database(IDatabase):
                     [Query(kind, {'%s <' % name: value}, orderings),
                      Query(kind, {'%s >' % name: value}), orderings], orderings)
             else:
-                return Query(kind, {'%s %s' % (name, op): value}, orderings)
-
+                return Query(kind, {'%s %s' % (name, op): value}, orderings, cursor)
+
+        # the query set is optimized, so the OR ed equalities are already
+        # collapsed, run the simple AND ed equalities and the inequalities
+        # of a single property (the datastore restriction) with one query,
+        # the results of the other queries are intersected
+        filters = {}
+        inequality = None
         result = []
         for q in qset:
             if len(q.items) > 1:
                 result.append(
                     MultiQuery([_query(item) for item in q.items], orderings))
+                continue
+            name, op, value = q.items[0]
+            key = '%s %s' % (name, op)
+            if op in ('<', '<=', '>', '>='):
+                if inequality not in (None, name):
+                    result.append(_query(q.items[0]))
+                    continue
+                inequality = name
+            if op not in ('in', '!=') and key not in filters:
+                filters[key] = value
             else:
                 result.append(_query(q.items[0]))
 
-        if not result:
-            return [Query(kind, {}, orderings)]
+        if filters or not result:
+            result.insert(0, Query(kind, filters, orderings, cursor))
 
         return result
 
 
 class Query(datastore.Query):
 
-    def __init__(self, kind, filters, orderings=None):
-        super(Query, self).__init__(kind, filters)
+    def __init__(self, kind, filters, orderings=None, cursor=None):
+        super(Query, self).__init__(kind, filters, cursor=cursor)
         if orderings:
             self.Order(*orderings)
 
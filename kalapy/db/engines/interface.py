@@ -9,6 +9,8 @@ instead.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+from kalapy.db.engines.utils import IdentityMap
+
 
 class IDatabase(object):
     """The database interface. Backend engines should implement this class
@@ -24,6 +26,9 @@ class IDatabase(object):
     #: mimetype of return value of :meth:`schema_table`.
     schema_mime = "text/plain"
 
+    #: whether the database is in read-only mode, see :meth:`set_readonly`
+    readonly = False
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         """Initialize the database.
         """
@@ -33,6 +38,9 @@ class IDatabase(object):
         self.user = user
         self.password = password
 
+        #: the instances loaded with this connection, see :class:`IdentityMap`
+        self.identity_map = IdentityMap()
+
     def connect(self):
         """Connect to the database.
         """
@@ -49,9 +57,20 @@ class IDatabase(object):
         raise NotImplementedError
 
     def rollback(self):
-        """Rollback all the changes made since the last commit.
+        """Rollback all the changes made since the last commit. The identity
+        map should be cleared as the loaded instances might be stale.
         """
         raise NotImplementedError
+
+    def set_readonly(self, readonly=True):
+        """Switch the database to read-only mode, or back. In read-only mode
+        the statements run without explicit transactions and the writes are
+        refused by the database, :meth:`commit` and :meth:`rollback` don't
+        talk to the database at all. The mode lasts until :meth:`close`.
+
+        :param readonly: whether to enable or disable the read-only mode
+        """
+        self.readonly = readonly
     
     def run_in_transaction(self, func, *args, **kw):
         """A helper function to run the specified func in a transaction. This
@@ -102,12 +121,24 @@ class IDatabase(object):
         raise NotImplementedError
 
     def create_table(self, model):
-        """Create a table for the given model if it doesn't exist.
+        """Create a table for the given model if it doesn't exist. The missing
+        indexes should be created as well, see :meth:`create_indexes`.
 
         :param model: a subclass of :class:`Model`
         """
         raise NotImplementedError
 
+    def create_indexes(self, model):
+        """Create the missing indexes for the given model, for the fields
+        declared with ``indexed=True``, the reference fields and the indexes
+        declared with ``__indexes__`` model attribute.
+
+        :param model: a subclass of :class:`Model`
+
+        :returns: list of names of the created indexes
+        """
+        raise NotImplementedError
+
     def alter_table(self, model, name=None):
         """Alter the table associated for the given model. If name is given look
         for the table by that name (if model class name has been changed).
@@ -131,6 +162,8 @@ class IDatabase(object):
 
             - Inserting records if records doesn't exist.
             - Updating `key` value of the given model instances.
+            - Updating the existing records with as few statements as
+              possible, for example by grouping them by the changed fields.
 
         :param instance: an instance of :class:`Model` subclass
         :param args: more instances
@@ -142,6 +175,25 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def insert_records(self, instances, batch_size=None):
+        """Insert database records for the given new model instances with as
+        few database statements as possible, and update their `key` values.
+
+        The implementation should insert the records in batches of given size
+        respecting the database limits, like the maximum number of statement
+        parameters.
+
+        :param instances: list of unsaved instances of :class:`Model` subclasses
+        :param batch_size: number of records to be inserted at once, if None
+                           use the engine default
+
+        :returns: list of key values
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        raise NotImplementedError
+
     def delete_records(self, instance, *args):
         """Delete database records for the given model instances. This method
         also accepts keys.
@@ -160,6 +212,51 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def update_where(self, qset, values):
+        """Update all the records matched by the given query set with the
+        given values at once.
+
+        For more information on query set, see :class:`db.query.QSet`.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param values: mapping of field names and values already converted
+                       with :meth:`Field.python_to_database`
+
+        :returns: number of records updated
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        raise NotImplementedError
+
+    def delete_where(self, qset):
+        """Delete all the records matched by the given query set at once.
+
+        For more information on query set, see :class:`db.query.QSet`.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+
+        :returns: number of records deleted
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        raise NotImplementedError
+
+    def fetch_record(self, model, key):
+        """Fetch a single record of the given model by its key. Unlike
+        :meth:`fetch`, the implementation should avoid the generic query
+        machinery as it is used to load instances by key.
+
+        :param model: a subclass of :class:`Model`
+        :param key: the record key
+
+        :returns: a dict of name, value mappings like :meth:`fetch` or None
+        :raises:
+            - :class:`db.DatabaseError`
+        """
+        raise NotImplementedError
+
     def fetch(self, qset, limit, offset):
         """Fetch records from database filtered by the given query set bound
         to given limit and offset.
@@ -169,6 +266,14 @@ class IDatabase(object):
         The implementation should return an iterator or generator of dict
         having ``name``, ``value`` mapping including ``key`` information.
 
+        The result should be streamed from the database instead of loading all
+        the records at once, so that large result sets can be iterated in
+        constant memory. The number of records to be read at once can be
+        configured with ``fetch_size`` option of ``settings.DATABASE_OPTIONS``.
+
+        If ``qset.fields`` is set, the implementation may only fetch the
+        given fields, ``key`` information is not required in that case.
+
         Database engine specific information can be passed with ``_payload``
         which will be stored as an attribute to the model instance.
 
@@ -182,6 +287,45 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def fetch_rows(self, qset, limit, offset):
+        """Same as :meth:`fetch` but returns the records as tuples of values
+        of the returned column names, which can be converted to the model
+        instances without creating a mapping for every record.
+
+        The default implementation returns the mappings given by :meth:`fetch`
+        with None as column names, which should be used by the engines not
+        supporting tuple results.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param limit: number of records to be fetch
+        :param offset: offset from where to fetch records
+
+        :returns: a tuple, the column names or None and an iterator of tuples
+                  of values or dict of name, value mappings if names are None
+        :raises:
+            - :class:`db.DatabaseError`
+        """
+        return None, self.fetch(qset, limit, offset)
+
+    def fetch_page(self, qset, limit, cursor=None):
+        """Fetch a page of records from database filtered by the given query
+        set, following the position represented by the given cursor.
+
+        Unlike :meth:`fetch` the implementation should not skip records to
+        reach the requested page, but should seek directly to the cursor
+        position, so that the cost doesn't depend on the page number.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param limit: number of records to be fetch
+        :param cursor: an opaque cursor string returned by previous call
+
+        :returns: a tuple, list of dict of name, value mappings and a cursor
+                  string for the next page or None if there are no more records
+        :raises:
+            - :class:`db.DatabaseError`
+        """
+        raise NotImplementedError
+
     def count(self, qset):
         """Returns the total number of records matched by given query set.
 
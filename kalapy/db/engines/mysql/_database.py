@@ -12,7 +12,7 @@ from MySQLdb.converters import conversions
 from MySQLdb.constants import FIELD_TYPE
 
 from kalapy.db.engines import utils
-from kalapy.db.engines.relational import RelationalDatabase
+from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder
 
 
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
@@ -43,14 +43,21 @@ class Database(RelationalDatabase):
 
     schema_mime = 'text/x-mysql'
 
+    # the default collations are case-insensitive
+    nocase_index = None
+
+    # LONGTEXT columns can only be indexed by a prefix
+    text_index_prefix = 255
+
+    #: whether the servers give consecutive keys to multi-row inserts, by
+    #: connection parameters, see :attr:`multirow_insert`
+    consecutive_keys = {}
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(Database, self).__init__(name, host, port, user, password)
         self.connection = None
 
-    def connect(self):
-        if self.connection is not None:
-            return self
-
+    def open_connection(self):
         args = {
             'db': self.name,
             'charset': 'utf8',
@@ -65,8 +72,18 @@ class Database(RelationalDatabase):
             args['host'] = self.host
         if self.port:
             args['port'] = self.port
-        self.connection = dbapi.connect(**args)
-        return self
+        return dbapi.connect(**args)
+
+    def set_autocommit(self, connection, autocommit):
+        connection.autocommit(autocommit)
+
+    def set_query_only(self, connection, query_only):
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SET SESSION TRANSACTION %s' % (
+                'READ ONLY' if query_only else 'READ WRITE'))
+        finally:
+            cursor.close()
 
     def fix_quote(self, sql):
         return sql.replace('"', '`')
@@ -80,7 +97,48 @@ class Database(RelationalDatabase):
             """, (model._meta.table, self.name,))
         return bool(cursor.fetchone()[0])
 
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT COUNT(*)
+                FROM information_schema.statistics
+                    WHERE table_name = %s AND table_schema = %s AND index_name = %s;
+            """, (model._meta.table, self.name, name,))
+        return bool(cursor.fetchone()[0])
+
     def lastrowid(self, cursor, model):
         cursor.execute('SELECT LAST_INSERT_ID()')
         return cursor.fetchone()[0]
 
+    @property
+    def multirow_insert(self):
+        # the keys of a multi-row insert are consecutive only with the
+        # "traditional" or "consecutive" auto-increment lock modes and the
+        # increment of 1, otherwise insert the records one by one
+        key = (self.name, self.host, self.port)
+        if key not in self.consecutive_keys:
+            cursor = self.cursor()
+            try:
+                cursor.execute(
+                    'SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment')
+                mode, increment = cursor.fetchone()
+            finally:
+                cursor.close()
+            self.consecutive_keys[key] = int(mode) != 2 and int(increment) == 1
+        return self.consecutive_keys[key]
+
+    def insert_keys(self, cursor, model, count):
+        # the key of the first record inserted by a multi-row insert, see
+        # multirow_insert
+        first = cursor.lastrowid
+        return range(first, first + count)
+
+    def builder(self, qset):
+        return MySQLQueryBuilder(qset, self.compile, self.max_in)
+
+
+class MySQLQueryBuilder(QueryBuilder):
+
+    # the default collations are case-insensitive, so the plain indexes
+    # can be used
+    nocase_eq = '%s = %%s'
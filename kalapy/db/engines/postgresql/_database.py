@@ -7,6 +7,8 @@ PostgreSQL backend engine.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+import itertools
+
 import psycopg2 as dbapi
 from psycopg2.extensions import UNICODE
 
@@ -16,6 +18,8 @@ from kalapy.db.engines.relational import RelationalDatabase
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
 
 
+_cursor_names = itertools.count(1)
+
 dbapi.extensions.register_type(UNICODE)
 
 DatabaseError = dbapi.DatabaseError
@@ -37,14 +41,15 @@ class Database(RelationalDatabase):
         "binary"    :   "BLOB",
     }
 
+    insert_returning = True
+
+    transactional_ddl = True
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(Database, self).__init__(name, host, port, user, password)
         self.connection = None
 
-    def connect(self):
-        if self.connection is not None:
-            return self
-
+    def open_connection(self):
         conn_string = 'dbname=%s' % self.name
         if self.user:
             conn_string = '%s user=%s' % (conn_string, self.user)
@@ -55,9 +60,30 @@ class Database(RelationalDatabase):
         if self.port:
             conn_string = '%s port=%s' % (conn_string, self.port)
 
-        self.connection = dbapi.connect(conn_string)
-        self.connection.set_isolation_level(1) # make transaction transparent to all cursors
-        return self
+        connection = dbapi.connect(conn_string)
+        connection.set_isolation_level(1) # make transaction transparent to all cursors
+        return connection
+
+    def set_autocommit(self, connection, autocommit):
+        connection.set_isolation_level(0 if autocommit else 1)
+
+    def set_query_only(self, connection, query_only):
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SET SESSION CHARACTERISTICS AS TRANSACTION %s' % (
+                'READ ONLY' if query_only else 'READ WRITE'))
+        finally:
+            cursor.close()
+
+    def stream_cursor(self):
+        # use a named cursor, results are kept on the server side and are
+        # transfered in batches of fetch_size rows
+        if not self.connection:
+            self.connect()
+        if self.readonly:
+            # named cursors can't be used outside of transactions
+            return self.cursor()
+        return self.connection.cursor('kalapy_cursor_%d' % _cursor_names.next())
 
     def exists_table(self, model):
         cursor = self.cursor()
@@ -67,6 +93,14 @@ class Database(RelationalDatabase):
             """, (model._meta.table,))
         return bool(cursor.fetchone())
 
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT relname FROM pg_class
+                WHERE relkind = 'i' AND relname = %s;
+            """, (name,))
+        return bool(cursor.fetchone())
+
     def lastrowid(self, cursor, model):
         cursor.execute('SELECT last_value FROM "%s_key_seq"' % model._meta.table)
         return cursor.fetchone()[0]
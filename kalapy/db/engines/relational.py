@@ -9,11 +9,16 @@ for relational database systems. Engines for an RDBMS should inherit from the
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
-import re
+import hashlib
+import itertools
+import threading
 
+from kalapy.conf import settings
+from kalapy.db.engines import utils
 from kalapy.db.engines.interface import IDatabase
 from kalapy.db.model import Model
 from kalapy.db.reference import ManyToOne
+from kalapy.utils.containers import LRUCache
 
 
 __all__ = ('RelationalDatabase',)
@@ -25,9 +30,55 @@ class RelationalDatabase(IDatabase):
 
     schema_mime = 'text/x-sql'
 
+    #: default number of rows to be read from a cursor at once
+    fetch_size = 100
+
+    #: cache of compiled sql statements, see :meth:`compile`
+    statements = LRUCache(settings.DATABASE_OPTIONS.get('statement_cache_size', 500))
+
+    #: default number of rows to be inserted with a single statement
+    batch_size = 500
+
+    #: maximum number of parameters of a single statement, None if unlimited
+    max_params = None
+
+    #: whether multiple rows can be inserted with a single statement
+    multirow_insert = True
+
+    #: whether the keys can be returned with ``INSERT ... RETURNING``
+    insert_returning = False
+
+    #: index column of the case-insensitive lookups of the indexed string
+    #: fields, see :meth:`QueryBuilder.handle_like`, None if not required
+    nocase_index = 'lower("%s")'
+
+    #: length of the prefix of the text columns to be indexed, None if the
+    #: whole values can be indexed
+    text_index_prefix = None
+
+    #: maximum number of values of an ``in`` filter passed as parameters,
+    #: the values of larger filters are loaded into a temporary table
+    max_in = 500
+
+    #: name of the temporary table created with the connections and shared
+    #: by the large ``in`` filters, None to create a temporary table for each
+    #: filter, see :meth:`create_temp_tables`
+    temp_table = None
+
+    #: whether the schema changes are rolled back with the transaction
+    transactional_ddl = False
+
+    #: the connection pools shared by the instances, see :meth:`get_pool`
+    pools = {}
+    pools_lock = threading.Lock()
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(RelationalDatabase, self).__init__(name, host, port, user, password)
         self.connection = None
+        self.pool = None
+        self.fetch_size = settings.DATABASE_OPTIONS.get('fetch_size', self.fetch_size)
+        self.batch_size = settings.DATABASE_OPTIONS.get('batch_size', self.batch_size)
+        self.max_in = settings.DATABASE_OPTIONS.get('max_in_size', self.max_in)
 
     def get_data_type(self, field):
         """Get the internal datatype for the given field supported by the
@@ -42,16 +93,137 @@ class RelationalDatabase(IDatabase):
             raise TypeError(
                 _('Unsupported datatype %(type)r', type=field.data_type))
 
+    def open_connection(self):
+        """Open a new `dbapi2` connection to the database. Subclasses should
+        implement this method instead of :meth:`connect`.
+        """
+        raise NotImplementedError
+
+    def ping(self, connection):
+        """Check whether the given `dbapi2` connection is still usable, used
+        by the connection pool before handing out a connection.
+
+        :raises: any database error if the connection is broken
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def get_pool(self):
+        """Return the connection pool for the connection parameters of this
+        database, or None if the pooling is disabled. The pool is configured
+        with the following ``settings.DATABASE_OPTIONS``:
+
+        ``pool_size``
+            maximum number of connections, 0 (the default) disables pooling
+        ``pool_min_size``
+            number of idle connections kept open, default 0
+        ``pool_timeout``
+            seconds to wait for a connection, default 30
+        ``pool_idle_timeout``
+            seconds after which an idle connection is closed, default 300
+        ``pool_max_lifetime``
+            seconds after which a connection is closed, default 3600
+        ``pool_check``
+            whether to check the connections on checkout, default True
+
+        See :class:`utils.Pool` for more details.
+        """
+        options = settings.DATABASE_OPTIONS
+        size = options.get('pool_size', 0)
+        if not size:
+            return None
+        key = (self.__class__, self.name, self.host, self.port, self.user)
+        self.pools_lock.acquire()
+        try:
+            pool = self.pools.get(key)
+            if pool is None:
+                # don't keep this instance, and its identity map, in the pool
+                factory = self.__class__(
+                    self.name, self.host, self.port, self.user, self.password)
+                pool = self.pools[key] = utils.Pool(factory.open_connection,
+                    check=factory.ping if options.get('pool_check', True) else None,
+                    min_size=options.get('pool_min_size', 0),
+                    max_size=size,
+                    timeout=options.get('pool_timeout', 30),
+                    idle_timeout=options.get('pool_idle_timeout', 300),
+                    max_lifetime=options.get('pool_max_lifetime', 3600))
+            return pool
+        finally:
+            self.pools_lock.release()
+
+    def set_autocommit(self, connection, autocommit):
+        """Switch the autocommit mode of the given `dbapi2` connection, used
+        by the read-only mode. Subclasses should implement this method.
+        """
+        raise NotImplementedError
+
+    def set_query_only(self, connection, query_only):
+        """Make the given `dbapi2` connection refuse or accept the writes, used
+        by the read-only mode. Subclasses should implement this method.
+        """
+        raise NotImplementedError
+
+    def switch_mode(self, connection, readonly):
+        """Switch the given `dbapi2` connection to read-only mode, or back to
+        the normal transactional mode.
+        """
+        # the session settings are changed outside of the transactions
+        if readonly:
+            self.set_autocommit(connection, True)
+            self.set_query_only(connection, True)
+        else:
+            self.set_query_only(connection, False)
+            self.set_autocommit(connection, False)
+
+    def set_readonly(self, readonly=True):
+        if readonly == self.readonly:
+            return
+        if self.connection is not None:
+            # end the pending transaction before switching the mode
+            self.commit()
+            self.switch_mode(self.connection, readonly)
+        self.readonly = readonly
+
+    def connect(self):
+        if self.connection is None:
+            self.pool = self.get_pool()
+            if self.pool is not None:
+                self.connection = self.pool.acquire()
+            else:
+                self.connection = self.open_connection()
+            if self.readonly:
+                self.switch_mode(self.connection, True)
+        return self
+
     def close(self):
         if self.connection:
-            self.connection.close()
+            if self.pool is not None:
+                discard = False
+                if self.readonly:
+                    # don't hand out read-only connections to other users
+                    try:
+                        self.switch_mode(self.connection, False)
+                    except Exception:
+                        discard = True
+                # return the connection to the pool after rollback
+                self.pool.release(self.connection, discard)
+            else:
+                self.connection.close()
         self.connection = None
+        self.readonly = False
 
     def commit(self):
-        self.connection.commit()
+        if self.connection is not None and not self.readonly:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        self.identity_map.clear()
+        if self.connection is not None and not self.readonly:
+            self.connection.rollback()
 
     def cursor(self):
         """Return a `dbapi2` complaint cursor instance.
@@ -60,6 +232,13 @@ class RelationalDatabase(IDatabase):
             self.connect()
         return self.connection.cursor()
 
+    def stream_cursor(self):
+        """Return a `dbapi2` complaint cursor instance to be used to stream
+        large result sets. Subclasses should override this method if the
+        database supports server side cursors.
+        """
+        return self.cursor()
+
     def fix_quote(self, sql):
         """Subclass should override this method to fix quotation marks.
         """
@@ -90,9 +269,11 @@ class RelationalDatabase(IDatabase):
         # create columns
         output = [self.get_field_sql(f) for f in fields]
 
-        # generate foreign key constraints
+        # generate foreign key constraints, the models stored in the other
+        # databases can't be referenced
         for field in fields:
-            if isinstance(field, ManyToOne):
+            if isinstance(field, ManyToOne) and \
+               field.reference._meta.database == model._meta.database:
                 output.append(self.get_fk_sql(field))
 
         # generate unique constraints
@@ -103,13 +284,92 @@ class RelationalDatabase(IDatabase):
         output = 'CREATE TABLE "%s" (\n    %s\n);' % (model._meta.table, output)
         return self.fix_quote(output)
 
+    def get_indexes(self, model):
+        """Get the indexes of the given model, for the fields declared with
+        ``indexed=True``, the reference fields and the ``__indexes__``.
+
+        :param model: a subclass of :class:`Model`
+
+        The indexed string fields get an additional index for case-insensitive
+        lookups, see :attr:`nocase_index`.
+
+        :returns: list of (name, columns) tuples where columns is a tuple of
+                  the index column expressions
+        """
+        table = model._meta.table
+
+        items = []
+        for field in model.fields().values():
+            if field._data_type is None or field.name == 'key':
+                continue
+            if field.is_indexed and self.nocase_index and \
+                    field.data_type in ('char', 'text'):
+                items.append(('%s_nocase' % field.name,
+                              [self.nocase_index % field.name]))
+            if field.is_unique:
+                continue
+            if field.is_indexed or isinstance(field, ManyToOne):
+                items.append((field.name, [self.get_index_column(field, 'ASC')]))
+        for item in model._meta.indexes:
+            items.append(('_'.join([f.name if how == 'ASC' else '%s_desc' % f.name
+                                    for f, how in item]),
+                          [self.get_index_column(f, how) for f, how in item]))
+
+        result = []
+        for suffix, columns in items:
+            name = '%s_%s_idx' % (table, suffix)
+            if len(name) > 63: # the limit of most of the databases
+                name = '%s_%s' % (name[:54], hashlib.md5(name).hexdigest()[:8])
+            if name not in [n for n, c in result]:
+                result.append((name, tuple(columns)))
+        return result
+
+    def get_index_column(self, field, how):
+        """Get the index column expression of the given field, see
+        :attr:`text_index_prefix`.
+
+        :param field: an instance of :class:`Field`
+        :param how: the order, `ASC` or `DESC`
+        """
+        if self.text_index_prefix and field.data_type == 'text':
+            return '"%s"(%d) %s' % (field.name, self.text_index_prefix, how)
+        return '"%s" %s' % (field.name, how)
+
+    def get_index_sql(self, model, name, columns):
+        sql = 'CREATE INDEX "%s" ON "%s" (%s)' % (name, model._meta.table,
+                ", ".join(columns))
+        return self.fix_quote(sql)
+
+    def exists_index(self, model, name):
+        """Check whether the index exists or not.
+
+        :param model: a subclass of :class:`Model`
+        :param name: name of the index
+
+        :returns: True if the index exists else False
+        """
+        raise NotImplementedError
+
     def schema_table(self, model):
-        return self.get_create_sql(model)
+        output = [self.get_create_sql(model)]
+        for name, columns in self.get_indexes(model):
+            output.append('%s;' % self.get_index_sql(model, name, columns))
+        return "\n".join(output)
 
     def create_table(self, model):
         if not self.exists_table(model):
             cursor = self.cursor()
             cursor.execute(self.get_create_sql(model))
+        self.create_indexes(model)
+
+    def create_indexes(self, model):
+        result = []
+        cursor = self.cursor()
+        for name, columns in self.get_indexes(model):
+            if not self.exists_index(model, name):
+                cursor.execute(self.get_index_sql(model, name, columns))
+                result.append(name)
+        return result
 
     def drop_table(self, model):
         if self.exists_table(model):
@@ -128,9 +388,127 @@ class RelationalDatabase(IDatabase):
     def lastrowid(self, cursor, model):
         return cursor.lastrowid
 
+    def insert_keys(self, cursor, model, count):
+        """Return the keys of the records inserted by the last statement
+        executed with the given cursor. Subclasses should override this method
+        if the database doesn't give the key of the last inserted record.
+
+        :param cursor: the cursor used to insert the records
+        :param model: the model of the inserted records
+        :param count: number of records inserted
+        """
+        if self.insert_returning:
+            return [row[0] for row in cursor.fetchall()]
+        last = self.lastrowid(cursor, model)
+        return range(last - count + 1, last + 1)
+
+    def insert_sql(self, table, names, count):
+        """Build an ``INSERT`` statement for the given number of rows.
+        """
+        values = "(%s)" % ", ".join(['%s'] * len(names))
+        sql = 'INSERT INTO "%s" (%s) VALUES %s' % (table,
+                ", ".join(['"%s"' % n for n in names]),
+                ", ".join([values] * count))
+        if self.insert_returning:
+            sql += ' RETURNING "key"'
+        return sql
+
+    def builder(self, qset):
+        """Return a :class:`QueryBuilder` for the given query set. Subclasses
+        should override this method to use an engine specific query builder.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        """
+        return QueryBuilder(qset, self.compile, self.max_in)
+
+    def create_temp_tables(self, builder):
+        """Create the temporary tables holding the values of the large ``in``
+        filters of the given query builder, see :attr:`max_in`.
+
+        :param builder: an instance of :class:`QueryBuilder`
+        """
+        if not builder.temp_tables:
+            return
+        cursor = self.cursor()
+        # the temporary tables are private to the connection, allow them to
+        # be written in read-only mode
+        if self.readonly:
+            self.set_query_only(self.connection, False)
+        try:
+            for table, name, values in builder.temp_tables:
+                if self.temp_table:
+                    # the values are tagged with the name of the table
+                    sql = self.fix_quote('INSERT INTO "%s" ("tag", "value") '
+                                         'VALUES (%%s, %%s)' % self.temp_table)
+                    cursor.executemany(sql, [(table, v) for v in values])
+                    continue
+                field = builder.model._meta.fields[name]
+                data_type = self.data_types['reference'] \
+                    if field.data_type == 'key' else self.get_data_type(field)
+                cursor.execute(self.fix_quote(
+                    'CREATE TEMPORARY TABLE "%s" ("value" %s)' % (table, data_type)))
+                sql = self.fix_quote('INSERT INTO "%s" ("value") VALUES (%%s)' % table)
+                cursor.executemany(sql, [(v,) for v in values])
+        finally:
+            if self.readonly:
+                self.set_query_only(self.connection, True)
+
+    def drop_temp_tables(self, builder, failed=False):
+        """Drop the temporary tables created with :meth:`create_temp_tables`.
+
+        :param builder: an instance of :class:`QueryBuilder`
+        :param failed: whether the statement using the tables failed
+        """
+        if not builder.temp_tables:
+            return
+        if failed:
+            if self.transactional_ddl:
+                # the transaction is aborted, the tables are discarded with
+                # the rollback and the statements would fail until then
+                return
+            try:
+                self.drop_temp_tables(builder)
+            except Exception:
+                pass
+            return
+        cursor = self.cursor()
+        if self.readonly:
+            self.set_query_only(self.connection, False)
+        try:
+            for table, name, values in builder.temp_tables:
+                if self.temp_table:
+                    cursor.execute(self.fix_quote('DELETE FROM "%s" WHERE "tag" = %%s'
+                                                  % self.temp_table), (table,))
+                else:
+                    cursor.execute(self.fix_quote('DROP TABLE "%s"' % table))
+        finally:
+            if self.readonly:
+                self.set_query_only(self.connection, True)
+
+    def compile(self, key, build):
+        """Get the compiled sql statement for the given query shape from
+        the statement cache, building it with the given callable only if
+        it is not cached yet.
+
+        The cache is shared among all the database connections and
+        :attr:`statements` can be inspected for the cache hits and misses.
+
+        :param key: a hashable representing the query shape, if None the
+                    statement is built but not cached
+        :param build: a callable returning the sql statement
+        """
+        if key is None:
+            return self.fix_quote(build())
+        key = (self.__class__,) + key
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = self.statements[key] = self.fix_quote(build())
+        return sql
+
     def update_records(self, instance, *args):
 
         result = []
+        updates = {}
         instances = [instance] + list(args)
 
         cursor = self.cursor()
@@ -139,32 +517,77 @@ class RelationalDatabase(IDatabase):
 
             assert isinstance(obj, Model), 'update_records expects Model instances'
 
-            items = obj._to_database_values(True).items()
+            values = obj._to_database_values(True)
 
-            keys = [x[0] for x in items]
-            vals = [x[1] for x in items]
+            table = obj._meta.table
+            names = tuple(sorted(values))
+            vals = [values[n] for n in names]
 
             if not obj.is_saved:
-                keys = ['"%s"' % k for k in keys]
-                sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
-                        obj._meta.table,
-                        ", ".join(keys),
-                        ", ".join(['%s'] * len(vals)))
-                cursor.execute(self.fix_quote(sql), vals)
-                obj._key = self.lastrowid(cursor, obj.__class__)
+                sql = self.compile((table, 'insert', names, 1), lambda: \
+                    self.insert_sql(table, names, 1))
+                cursor.execute(sql, vals)
+                obj._key = self.insert_keys(cursor, obj.__class__, 1)[0]
                 result.append(obj.key)
+                self.identity_map.add(obj)
+                obj.set_dirty(False)
             else:
-                keys = ", ".join(['"%s" = %%s' % k for k in keys])
-                sql = 'UPDATE "%s" SET %s WHERE "key" = %%s' % (obj._meta.table, keys)
-
+                # group the updates by the changed columns
                 vals.append(obj.key)
-                cursor.execute(self.fix_quote(sql), vals)
+                updates.setdefault((table, names), []).append((obj, vals))
                 result.append(obj.key)
 
-            obj.set_dirty(False)
+        for (table, names), group in updates.items():
+            sql = self.compile((table, 'update', names), lambda: \
+                'UPDATE "%s" SET %s WHERE "key" = %%s' % (table,
+                    ", ".join(['"%s" = %%s' % n for n in names])))
+            params = [vals for obj, vals in group]
+            if len(params) == 1:
+                cursor.execute(sql, params[0])
+            else:
+                cursor.executemany(sql, params)
+            # the records are clean only once they are updated
+            for obj, vals in group:
+                obj.set_dirty(False)
 
         return result
 
+    def insert_records(self, instances, batch_size=None):
+
+        batch_size = batch_size or self.batch_size
+
+        # group the records by the given values to insert them at once
+        groups = {}
+        for obj in instances:
+            assert isinstance(obj, Model), 'insert_records expects Model instances'
+            values = obj._to_database_values(True)
+            names = tuple(sorted(values))
+            groups.setdefault((obj._meta.table, names), []).append(
+                (obj, [values[n] for n in names]))
+
+        cursor = self.cursor()
+
+        for (table, names), items in groups.items():
+            size = batch_size if self.multirow_insert and names else 1
+            if self.max_params and names:
+                size = max(1, min(size, self.max_params // len(names)))
+
+            for i in range(0, len(items), size):
+                batch = items[i:i+size]
+                sql = self.compile((table, 'insert', names, len(batch)), lambda: \
+                    self.insert_sql(table, names, len(batch)))
+                params = []
+                for obj, vals in batch:
+                    params.extend(vals)
+                cursor.execute(sql, params)
+                keys = self.insert_keys(cursor, batch[0][0].__class__, len(batch))
+                for (obj, vals), key in zip(batch, keys):
+                    obj._key = key
+                    obj.set_dirty(False)
+                    self.identity_map.add(obj)
+
+        return [obj.key for obj in instances]
+
     def delete_records(self, instance, *args):
 
         assert isinstance(instance, Model), 'delete_records expectes Model instances'
@@ -174,39 +597,175 @@ class RelationalDatabase(IDatabase):
 
         keys = [o.key for o in instances]
 
-        sql = 'DELETE FROM "%s" WHERE "key" IN (%s)' % (
-                            instance._meta.table, ", ".join(['%s'] * len(keys)))
+        table = instance._meta.table
+        sql = self.compile((table, 'delete', len(keys)), lambda: \
+            'DELETE FROM "%s" WHERE "key" IN (%s)' % (
+                table, ", ".join(['%s'] * len(keys))))
 
         cursor = self.cursor()
-        cursor.execute(self.fix_quote(sql), keys)
+        cursor.execute(sql, keys)
 
+        self.identity_map.discard(*instances)
         for obj in instances:
             obj._key = None
             obj.set_dirty(True)
 
         return keys
 
-    def fetch(self, qset, limit, offset):
+    def update_where(self, qset, values):
+        if not values:
+            return 0
+        self.identity_map.clear(qset.model)
+        builder = self.builder(qset)
+        sql, params = builder.update(values)
+        self.create_temp_tables(builder)
         cursor = self.cursor()
-        sql, params = QueryBuilder(qset).select('*', limit, offset)
-        cursor.execute(self.fix_quote(sql), params)
-        names = [desc[0] for desc in cursor.description]
-        for row in cursor.fetchall():
-            yield dict([(name, row[i]) for i, name in enumerate(names)])
+        try:
+            cursor.execute(sql, params)
+        except:
+            self.drop_temp_tables(builder, failed=True)
+            raise
+        self.drop_temp_tables(builder)
+        return cursor.rowcount
+
+    def delete_where(self, qset):
+        self.identity_map.clear(qset.model, related=True)
+        builder = self.builder(qset)
+        sql, params = builder.delete()
+        self.create_temp_tables(builder)
+        cursor = self.cursor()
+        try:
+            cursor.execute(sql, params)
+        except:
+            self.drop_temp_tables(builder, failed=True)
+            raise
+        self.drop_temp_tables(builder)
+        return cursor.rowcount
+
+    def fetch_record(self, model, key):
+        table = model._meta.table
+        sql = self.compile((table, 'get'), lambda: \
+            'SELECT * FROM "%s" WHERE "key" = %%s' % table)
+        cursor = self.cursor()
+        try:
+            cursor.execute(sql, [key])
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([desc[0] for desc in cursor.description], row))
+        finally:
+            cursor.close()
+
+    def select_rows(self, builder, limit, offset):
+        """Execute the select query of the given query builder and return the
+        column names and an iterator streaming the result rows.
+
+        :param builder: an instance of :class:`QueryBuilder`
+        :param limit: number of records to be fetch
+        :param offset: offset from where to fetch records
+
+        :returns: a tuple, tuple of column names and iterator of row tuples
+        """
+        sql, params = builder.select(None, limit, offset)
+        self.create_temp_tables(builder)
+        cursor = self.stream_cursor() if limit == -1 else self.cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(self.fetch_size)
+            names = tuple([desc[0] for desc in cursor.description or []])
+        except:
+            self.drop_temp_tables(builder, failed=True)
+            raise
+
+        def stream(rows):
+            failed = True
+            try:
+                while rows:
+                    for row in rows:
+                        yield row
+                    rows = cursor.fetchmany(self.fetch_size)
+                failed = False
+            finally:
+                try:
+                    cursor.close()
+                finally:
+                    self.drop_temp_tables(builder, failed)
+
+        return names, stream(rows)
+
+    def fetch(self, qset, limit, offset):
+        builder = self.builder(qset)
+        names, rows = self.select_rows(builder, limit, offset)
+        for row in rows:
+            yield builder.values(names, row)
+
+    def fetch_rows(self, qset, limit, offset):
+        builder = self.builder(qset)
+        if builder.joins:
+            # the related values are nested, see QueryBuilder.values
+            return None, self.fetch(qset, limit, offset)
+        return self.select_rows(builder, limit, offset)
+
+    def fetch_page(self, qset, limit, cursor=None):
+        builder = self.builder(qset)
+        names = builder.seek(utils.decode_cursor(cursor) if cursor else None)
+        # one more row tells whether there is a next page
+        sql, params = builder.select(None, limit + 1 if limit >= 0 else limit)
+
+        self.create_temp_tables(builder)
+        c = self.cursor()
+        try:
+            c.execute(sql, params)
+            columns = [desc[0] for desc in c.description]
+            result = [builder.values(columns, row) for row in c.fetchall()]
+        except:
+            self.drop_temp_tables(builder, failed=True)
+            raise
+        self.drop_temp_tables(builder)
+
+        if limit < 0 or len(result) <= limit:
+            return result, None
+
+        result = result[:limit]
+        last = result[-1]
+        return result, utils.encode_cursor(*[last[n] for n in names])
 
     def count(self, qset):
+        builder = self.builder(qset)
+        sql, params = builder.select('count("key")', order=False)
+        self.create_temp_tables(builder)
         cursor = self.cursor()
-        sql, params = QueryBuilder(qset).select('count("key")')
-        sql = re.sub(' ORDER BY "\w+" (ASC|DESC)', '', sql)
-        cursor.execute(self.fix_quote(sql), params)
         try:
-            return cursor.fetchone()[0]
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
         except:
-            return 0
+            self.drop_temp_tables(builder, failed=True)
+            raise
+        self.drop_temp_tables(builder)
+        return row[0] if row else 0
 
 
 class QueryBuilder(object):
     """The SQL query builder for relational database engines.
+
+    The query text only depends on the shape of the query set (fields,
+    operators and number of items of ``in`` filters), so the builder
+    accepts a `compile` callable, see :meth:`RelationalDatabase.compile`,
+    to cache the generated statements. Only the parameters are computed
+    for every query.
+
+    If the query set has related fields, see :meth:`db.Query.select_related`,
+    the referenced tables are joined with ``LEFT JOIN`` and their columns are
+    aliased as ``field__column``.
+
+    The ``in`` filters with more than `max_in` values are matched against a
+    temporary table, see :meth:`RelationalDatabase.create_temp_tables`, which
+    keeps the number of parameters bounded. Such statements are not cached.
+
+    :param qset: the query set, an instance of :class:`db.query.QSet`
+    :param compile: a callable to lookup compiled statement by query shape
+    :param max_in: maximum number of values of an ``in`` filter passed as
+                   parameters, None if unlimited
     """
 
     op_alias = {
@@ -221,112 +780,273 @@ class QueryBuilder(object):
         'not in': 'not_in',
     }
 
-    def __init__(self, qset):
+    #: case-insensitive equality of string fields, it should match the
+    #: :attr:`RelationalDatabase.nocase_index` so that the index is used
+    nocase_eq = 'lower(%s) = lower(%%s)'
+
+    #: sequence to generate unique names of the temporary tables
+    temp_names = itertools.count()
+
+    #: the sub-select of the values of a temporary table
+    in_table = '(SELECT "value" FROM "%s")'
+
+    def __init__(self, qset, compile=None, max_in=None):
         self.qset = qset
         self.model = qset.model
-        self.order = None
+        self.order = [tuple(qset.order)] if qset.order else []
+        self.compile = compile or (lambda key, build: build())
+        self.fields = qset.fields
         self.all = []
+        self.params = []
+
+        # the temporary tables of large in filters, as (table, name, values)
+        self.temp_tables = []
+
+        # the related tables to be joined, as (path, alias, model) tuples
+        self.joins = []
+        self.joined = False
+
+        related = () if self.fields else (qset.related or ())
+        if related:
+            models = {'': self.model}
+            aliases = {'': 't0'}
+            self.joins.append(('', 't0', self.model))
+            for i, path in enumerate(sorted(related)):
+                parent, name = path.rsplit('.', 1) if '.' in path else ('', path)
+                models[path] = models[parent]._meta.fields[name].reference
+                aliases[path] = 't%d' % (i + 1)
+                self.joins.append((path, aliases[path], models[path]))
+
+        shape = []
+        for q in qset:
+            items = [self.parse(name, op, val) for name, op, val in q.items]
+            for i, (name, op, val) in enumerate(items):
+                if op in ('in', 'not_in') and max_in and len(val) > max_in:
+                    table = 'kalapy_in_%d' % self.temp_names.next()
+                    self.temp_tables.append((table, name, val))
+                    items[i] = (name, '%s_table' % op, table)
+                elif isinstance(val, (list, tuple)):
+                    self.params.extend(val)
+                else:
+                    self.params.append(val)
+            self.all.append(items)
+            shape.append(tuple([(name, op, len(val) \
+                if isinstance(val, (list, tuple)) else None) \
+                    for name, op, val in items]))
+
+        self.shape = (self.model._meta.table, tuple(shape), self.fields, related)
+        self.cached = not self.temp_tables
+
+    def seek(self, values=None):
+        """Prepare the query for keyset pagination. The result will be ordered
+        by the current order field and `key` as tie breaker. If values are
+        given, only records following the given values are matched.
+
+        :param values: values of the order field and the key of the last
+                       record of the previous page
+
+        :returns: list of column names the result is ordered by
+        """
+        name, how = self.order[0] if self.order else ('key', 'ASC')
+        names = [name, 'key'] if name != 'key' else ['key']
+        self.order = [(n, how) for n in names]
+        if self.fields:
+            self.fields = self.fields + tuple([n for n in names if n not in self.fields])
+        table, shape, fields, related = self.shape
+        if values:
+            if len(values) != len(names):
+                raise ValueError(_('Invalid cursor for the query'))
+            op = 'after_%s' % how.lower()
+            self.all.append([(tuple(names), op, list(values))])
+            self.params.extend(values)
+            shape = shape + (((tuple(names), op, len(values)),),)
+        self.shape = (table, shape, self.fields, related)
+        return names
+
+    def column(self, name):
+        """Get the quoted column name, qualified with the table alias if the
+        related tables are joined.
+        """
+        if self.joined:
+            return '"t0"."%s"' % name
+        return '"%s"' % name
 
-        try:
-            self.order = "ORDER BY \"%s\" %s" % tuple(qset.order)
-        except:
-            pass
+    def columns(self):
+        """Get the column list for the SELECT query.
+        """
+        if self.fields:
+            return ", ".join([self.column(n) for n in self.fields])
+        if not self.joined:
+            return "*"
+        paths = set([path for path, alias, model in self.joins])
+        result = []
+        for path, alias, model in self.joins:
+            prefix = path.replace('.', '__') + '__' if path else ''
+            for name in model._meta.fields:
+                if ('%s.%s' % (path, name) if path else name) not in paths:
+                    result.append('"%s"."%s" AS "%s%s"' % (alias, name, prefix, name))
+        return ", ".join(result)
+
+    def table(self):
+        """Get the table expression for the SELECT query.
+        """
+        if not self.joined:
+            return '"%s"' % self.model._meta.table
+        aliases = dict([(path, alias) for path, alias, model in self.joins])
+        result = '"%s" AS "t0"' % self.model._meta.table
+        for path, alias, model in self.joins[1:]:
+            parent, name = path.rsplit('.', 1) if '.' in path else ('', path)
+            result = '%s LEFT JOIN "%s" AS "%s" ON "%s"."key" = "%s"."%s"' % (
+                result, model._meta.table, alias, alias, aliases[parent], name)
+        return result
 
-        for q in qset:
-            if len(q.items) > 1:
-                statements = []
-                params = []
-                for item in q.items:
-                    name, op, val = item
-                    s, p = self.parse(name, op, val)
-                    statements.append(s)
-                    if isinstance(p, (list, tuple)):
-                        params.extend(p)
-                    else:
-                        params.append(p)
-                self.all.append((" OR ".join(statements), params))
-            else:
-                name, op, val = q.items[0]
-                self.all.append(self.parse(name, op, val))
+    def values(self, names, row):
+        """Create a mapping of column names and values from the given result
+        row. The values of the related tables are nested by the field names.
+        """
+        if not self.joined:
+            return dict(zip(names, row))
+        result = {}
+        for name, value in zip(names, row):
+            parts = name.split('__')
+            values = result
+            for part in parts[:-1]:
+                values = values.setdefault(part, {})
+            values[parts[-1]] = value
+        return result
 
-    def select(self, what, limit=None, offset=None):
+    def where(self, query):
+        """Append the WHERE clause to the given query.
+        """
+        if not self.all:
+            return query
+        statements = []
+        for items in self.all:
+            statements.append(" OR ".join([
+                getattr(self, 'handle_%s' % op)(name, val) for name, op, val in items]))
+        return "%s WHERE %s" % (query, " AND ".join(["(%s)" % s for s in statements]))
+
+    def select(self, what=None, limit=None, offset=None, order=True):
         """Build the select query.
+
+        :param what: the select expression, if None select the columns given
+                     by the query set including the columns of related tables
+
+        :returns: a tuple `(str, params)`
         """
-        query = "SELECT %s FROM \"%s\"" % (what, self.model._meta.table)
-        if self.all:
-            query = "%s WHERE %s" % (query, " AND ".join(["(%s)" % s for s, b in self.all]))
-        if self.order:
-            query = "%s %s" % (query, self.order)
-        if limit > -1:
-            query = "%s LIMIT %d" % (query, limit)
-            if offset > -1:
-                query = "%s OFFSET %d" % (query, offset)
-
-        params = []
-        for q, v in self.all:
-            if isinstance(v, (list, tuple)):
-                params.extend(v)
-            else:
-                params.append(v)
+        order = tuple(self.order) if order else ()
+        limit = limit if limit > -1 else None
+        offset = offset if limit is not None and offset > -1 else None
+
+        self.joined = what is None and bool(self.joins)
+
+        def build():
+            query = self.where("SELECT %s FROM %s" % (
+                what or self.columns(), self.table()))
+            if order:
+                query = "%s ORDER BY %s" % (query, ", ".join([
+                    '%s %s' % (self.column(n), how) for n, how in order]))
+            if limit is not None:
+                query = "%s LIMIT %%s" % query
+                if offset is not None:
+                    query = "%s OFFSET %%s" % query
+            return query
+
+        query = self.compile(self.cached and self.shape + ('select', what, order,
+                limit is not None, offset is not None) or None, build)
+
+        params = list(self.params)
+        if limit is not None:
+            params.append(limit)
+            if offset is not None:
+                params.append(offset)
 
         return query, params
 
+    def update(self, values):
+        """Build the update query.
+
+        :param values: mapping of column names and database values
+
+        :returns: a tuple `(str, params)`
+        """
+        names = tuple(sorted(values))
+
+        def build():
+            return self.where("UPDATE \"%s\" SET %s" % (self.model._meta.table,
+                ", ".join(['"%s" = %%s' % n for n in names])))
+
+        query = self.compile(self.cached and self.shape + ('update', names) or None, build)
+        return query, [values[n] for n in names] + self.params
+
+    def delete(self):
+        """Build the delete query.
+
+        :returns: a tuple `(str, params)`
+        """
+        def build():
+            return self.where("DELETE FROM \"%s\"" % self.model._meta.table)
+
+        query = self.compile(self.cached and self.shape + ('delete',) or None, build)
+        return query, list(self.params)
+
     def parse(self, name, operator, value):
         """Parse the simple query statement.
 
         :param name: name of the field
         :param operator: the operator
-        :param value: the filter values
+        :param value: the filter values, already converted to the database
+                      values, see :meth:`db.Q.validate`
 
-        :returns: a tuple `(str, value)`
+        :returns: a tuple `(name, op, value)`
         :rtype: tuple
         """
-        field = self.model._meta.fields[name]
-
         op = operator.lower()
         op = self.op_alias.get(op, op)
+        if op in ('in', 'not_in'):
+            assert isinstance(value, (list, tuple))
+        return name, op, value
 
-        handler = getattr(self, 'handle_%s' % op)
-        validator = getattr(self, 'validate_%s' % op, self.validate)
-        value = validator(field, value)
-
-        return handler(name, value), value
-
-    def validate(self, field, value):
-        return field.python_to_database(value)
+    def handle_in(self, name, value):
+        return '%s IN (%s)' % (self.column(name), ', '.join(['%s'] * len(value)))
 
-    def validate_in(self, field, value):
+    def handle_not_in(self, name, value):
         assert isinstance(value, (list, tuple))
-        return [field.python_to_database(v) for v in value]
+        return '%s NOT IN (%s)' % (self.column(name), ', '.join(['%s'] * len(value)))
 
-    def validate_not_in(self, field, value):
-        return self.validate_in(field, value)
+    def handle_in_table(self, name, value):
+        return '%s IN %s' % (self.column(name), self.in_table % value)
 
-    def handle_in(self, name, value):
-        return '"%s" IN (%s)' % (name, ', '.join(['%s'] * len(value)))
+    def handle_not_in_table(self, name, value):
+        return '%s NOT IN %s' % (self.column(name), self.in_table % value)
 
-    def handle_not_in(self, name, value):
-        assert isinstance(value, (list, tuple))
-        return '"%s" NOT IN (%s)' % (name, ', '.join(['%s'] * len(value)))
+    def handle_after_asc(self, names, value):
+        return '(%s) > (%s)' % (
+            ', '.join(map(self.column, names)), ', '.join(['%s'] * len(value)))
+
+    def handle_after_desc(self, names, value):
+        return '(%s) < (%s)' % (
+            ', '.join(map(self.column, names)), ', '.join(['%s'] * len(value)))
 
     def handle_like(self, name, value):
-        return '"%s" LIKE %%s' % (name)
+        if self.model._meta.fields[name].data_type in ('char', 'text'):
+            return self.nocase_eq % self.column(name)
+        return self.handle_eq(name, value)
 
     def handle_eq(self, name, value):
-        return '"%s" = %%s' % (name)
+        return '%s = %%s' % self.column(name)
 
     def handle_neq(self, name, value):
-        return '"%s" != %%s' % (name)
+        return '%s != %%s' % self.column(name)
 
     def handle_gt(self, name, value):
-        return '"%s" > %%s' % (name)
+        return '%s > %%s' % self.column(name)
 
     def handle_lt(self, name, value):
-        return '"%s" < %%s' % (name)
+        return '%s < %%s' % self.column(name)
 
     def handle_gte(self, name, value):
-        return '"%s" >= %%s' % (name)
+        return '%s >= %%s' % self.column(name)
 
     def handle_lte(self, name, value):
-        return '"%s" <= %%s' % (name)
-
+        return '%s <= %%s' % self.column(name)
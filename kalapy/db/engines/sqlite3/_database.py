@@ -11,7 +11,8 @@ import os, decimal
 import sqlite3 as dbapi
 
 from kalapy.db.engines import utils
-from kalapy.db.engines.relational import RelationalDatabase
+from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder
+from kalapy.utils.containers import LRUCache
 
 
 dbapi.register_converter('bool', lambda s: s == '1')
@@ -43,17 +44,39 @@ class Database(RelationalDatabase):
         "binary"    :   "BLOB",
     }
 
-    def connect(self):
-        if self.connection is not None:
-            return self
+    # SQLITE_MAX_VARIABLE_NUMBER of the default builds
+    max_params = 999
 
+    multirow_insert = dbapi.sqlite_version_info >= (3, 7, 11)
+
+    # the sqlite3 module commits the pending transaction before the schema
+    # changes, the temporary table is created with the connection
+    temp_table = 'kalapy_in'
+
+    nocase_index = '"%s" COLLATE NOCASE'
+
+    def open_connection(self):
         if self.name != ":memory:":
             if not os.path.isfile(self.name):
                 raise DatabaseError(
                     _("Database %(name)r doesn't exist.", name=self.name))
 
-        self.connection = dbapi.connect(self.name, detect_types=dbapi.PARSE_DECLTYPES)
-        return self
+        # pooled connections may be used by other threads, but only by one
+        # thread at a time
+        connection = dbapi.connect(self.name, detect_types=dbapi.PARSE_DECLTYPES,
+                                   check_same_thread=False)
+        connection.execute('CREATE TEMPORARY TABLE "%s" ("tag" TEXT, "value")'
+                           % self.temp_table)
+        connection.execute('CREATE INDEX "%s_tag" ON "%s" ("tag")'
+                           % (self.temp_table, self.temp_table))
+        return connection
+
+    def set_autocommit(self, connection, autocommit):
+        # without isolation level the module doesn't issue implicit BEGIN
+        connection.isolation_level = None if autocommit else ''
+
+    def set_query_only(self, connection, query_only):
+        connection.execute('PRAGMA query_only = %s' % ('ON' if query_only else 'OFF'))
 
     def exists_table(self, model):
         cursor = self.cursor()
@@ -63,15 +86,37 @@ class Database(RelationalDatabase):
             """, (model._meta.table,))
         return bool(cursor.fetchone())
 
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT "name" FROM sqlite_master
+                WHERE type = "index" AND name = %s;
+            """, (name,))
+        return bool(cursor.fetchone())
+
 
     def cursor(self):
         if not self.connection:
             self.connect()
         return self.connection.cursor(factory=SQLiteCursor)
 
+    def builder(self, qset):
+        return SQLiteQueryBuilder(qset, self.compile, self.max_in)
+
+
+class SQLiteQueryBuilder(QueryBuilder):
+
+    nocase_eq = '%s = %%s COLLATE NOCASE'
+
+    # the values are stored in the shared temporary table, see Database
+    in_table = '(SELECT "value" FROM "kalapy_in" WHERE "tag" = \'%s\')'
+
 
 class SQLiteCursor(dbapi.Cursor):
 
+    #: cache of converted queries
+    queries = LRUCache(RelationalDatabase.statements.size)
+
     def execute(self, query, params=()):
         query = self.convert_query(query, len(params))
         return super(SQLiteCursor, self).execute(query, params)
@@ -81,5 +126,9 @@ class SQLiteCursor(dbapi.Cursor):
         return super(SQLiteCursor, self).executemany(query, params_list)
 
     def convert_query(self, query, num_params):
-        return query % tuple("?" * num_params)
+        key = (query, num_params)
+        result = self.queries.get(key)
+        if result is None:
+            result = self.queries[key] = query % tuple("?" * num_params)
+        return result
 
@@ -8,7 +8,12 @@ python to database and vice versa.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
-import re, decimal, datetime
+import re, time, base64, decimal, datetime, threading, weakref
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 
 re_datetime = re.compile(
@@ -59,3 +64,369 @@ def str_to_database(value):
     """
     return value.decode('utf-8')
 
+
+def encode_cursor(*values):
+    """Encode the given database values into an opaque websafe string, to be
+    used as a query cursor. Supports basic types, `decimal.Decimal` and date,
+    time or datetime values.
+
+    >>> decode_cursor(encode_cursor(u'some', 12))
+    [u'some', 12]
+
+    :returns: encoded string
+    """
+    items = []
+    for value in values:
+        if isinstance(value, datetime.datetime):
+            value = {'datetime': value.strftime('%Y-%m-%d %H:%M:%S.%f')}
+        elif isinstance(value, datetime.date):
+            value = {'date': value.strftime('%Y-%m-%d')}
+        elif isinstance(value, datetime.time):
+            value = {'time': value.strftime('%H:%M:%S.%f')}
+        elif isinstance(value, decimal.Decimal):
+            value = {'decimal': str(value)}
+        elif isinstance(value, str):
+            value = value.decode('utf-8')
+        items.append(value)
+    return base64.urlsafe_b64encode(json.dumps(items))
+
+def decode_cursor(cursor):
+    """Decode the given cursor string encoded with :func:`encode_cursor`.
+
+    :returns: list of values
+    :raises: `ValueError` if the cursor is malformed
+    """
+    try:
+        items = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        assert isinstance(items, list)
+    except Exception:
+        raise ValueError(_('Invalid cursor %(cursor)r', cursor=cursor))
+    for i, value in enumerate(items):
+        if isinstance(value, dict):
+            (kind, value), = value.items()
+            if kind == 'datetime':
+                value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+            elif kind == 'date':
+                value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            elif kind == 'time':
+                value = datetime.datetime.strptime(value, '%H:%M:%S.%f').time()
+            else:
+                value = decimal.Decimal(value)
+            items[i] = value
+    return items
+
+
+class IdentityMap(object):
+    """Keeps track of the model instances loaded or saved with a database
+    connection, so that a record is represented by a single instance.
+
+    The instances are referenced weakly, so iterating over large result sets
+    doesn't keep them in memory, except the pinned ones (the instances
+    fetched by key) which are kept until the map is cleared.
+    """
+
+    def __init__(self):
+        self.__instances = weakref.WeakValueDictionary()
+        self.__pinned = {}
+
+    def get(self, model, key):
+        """Return the instance of the given model with the given key or None.
+        """
+        return self.__instances.get((model._meta.table, key))
+
+    def add(self, instance, pin=False):
+        """Add the given saved instance to the map.
+
+        :param instance: a model instance
+        :param pin: if True keep a strong reference to the instance
+        """
+        k = (instance._meta.table, instance.key)
+        self.__instances[k] = instance
+        if pin:
+            self.__pinned[k] = instance
+
+    def discard(self, *instances):
+        """Remove the given deleted instances from the map. The instances of
+        the models referencing them are removed as well, as they might have
+        been changed by the database cascades.
+        """
+        related = set()
+        for instance in instances:
+            k = (instance._meta.table, instance.key)
+            self.__instances.pop(k, None)
+            self.__pinned.pop(k, None)
+            related.update(self.__related(instance))
+        for model in related:
+            self.clear(model)
+
+    def __related(self, model):
+        return [getattr(field, 'm2m', None) or field.reference
+                for field in model._meta.virtual_fields.values()]
+
+    def clear(self, model=None, related=False):
+        """Remove all the instances of the given model, or all the instances
+        if model is not given.
+
+        :param related: if True, remove the instances of the models
+                        referencing the given model as well, after deleting
+                        records which might have been cascaded
+        """
+        if model is None:
+            self.__instances.clear()
+            self.__pinned.clear()
+            return
+        if related:
+            for other in self.__related(model):
+                self.clear(other)
+        table = model._meta.table
+        for k in self.__instances.keys():
+            if k[0] == table:
+                self.__instances.pop(k, None)
+                self.__pinned.pop(k, None)
+
+    def __len__(self):
+        return len(self.__instances)
+
+
+class PoolError(Exception):
+    """Raised if a connection can't be borrowed from a :class:`Pool` within
+    the configured timeout.
+    """
+    pass
+
+
+class Pool(object):
+    """A thread-safe pool of database connections.
+
+    The connections are created with the given `connect` callable only when
+    no idle connection is available, and up to `max_size` connections can be
+    open at once. The borrowed connections should be returned with
+    :meth:`release` which rolls back any pending transaction.
+
+    The idle connections are closed once they are idle for more than
+    `idle_timeout` seconds, unless there are only `min_size` connections, and
+    all the connections are closed once they are open for more than
+    `max_lifetime` seconds. The connections are checked with the `check`
+    callable before they are handed out.
+
+    :param connect: a callable returning a new `dbapi2` connection
+    :param check: a callable accepting a connection and raising an error if
+                  the connection is not usable anymore, or None
+    :param min_size: number of connections to keep open
+    :param max_size: maximum number of open connections
+    :param timeout: seconds to wait for a connection if all are in use
+    :param idle_timeout: seconds after which an idle connection is closed
+    :param max_lifetime: seconds after which a connection is closed
+    """
+
+    def __init__(self, connect, check=None, min_size=0, max_size=10,
+                 timeout=30, idle_timeout=300, max_lifetime=3600):
+        self.connect = connect
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+
+        self.__lock = threading.Condition()
+        self.__idle = [] # (connection, created, released) tuples
+        self.__in_use = {} # id of connection -> created
+        self.__size = 0
+
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def __expired(self, created, released, now):
+        if self.max_lifetime and now - created > self.max_lifetime:
+            return True
+        return self.idle_timeout and now - released > self.idle_timeout \
+                                 and self.__size > self.min_size
+
+    def __close(self, connection):
+        # should be called with the lock held
+        self.__size -= 1
+        self.closed += 1
+        self.__lock.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def __checkout(self, deadline):
+        """Take an idle connection, or reserve a place for a new connection
+        if the pool is not full, waiting for a released connection otherwise.
+
+        :returns: a tuple `(connection, created)`, `(None, None)` if a new
+                  connection should be created
+        """
+        self.__lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                while self.__idle:
+                    connection, created, released = self.__idle.pop()
+                    if self.__expired(created, released, now):
+                        self.__close(connection)
+                        continue
+                    return connection, created
+                if self.__size < self.max_size:
+                    self.__size += 1
+                    return None, None
+                if now >= deadline:
+                    raise PoolError(
+                        _('No database connection available in %(timeout)s seconds.',
+                            timeout=self.timeout))
+                self.__lock.wait(deadline - now)
+        finally:
+            self.__lock.release()
+
+    def acquire(self):
+        """Borrow a connection from the pool.
+
+        :returns: a `dbapi2` connection
+        :raises: :class:`PoolError` if no connection is available in time
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        while True:
+            connection, created = self.__checkout(deadline)
+            new = connection is None
+            if new:
+                try:
+                    connection = self.connect()
+                except:
+                    self.__lock.acquire()
+                    try:
+                        self.__size -= 1
+                        self.__lock.notify()
+                    finally:
+                        self.__lock.release()
+                    raise
+                created = time.time()
+            elif self.check is not None:
+                try:
+                    self.check(connection)
+                except Exception:
+                    self.__lock.acquire()
+                    try:
+                        self.__close(connection)
+                    finally:
+                        self.__lock.release()
+                    continue
+            break
+
+        wait = time.time() - start
+        self.__lock.acquire()
+        try:
+            self.__in_use[id(connection)] = created
+            self.created += new
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+        finally:
+            self.__lock.release()
+        return connection
+
+    def release(self, connection, discard=False):
+        """Return the given connection to the pool. Any pending transaction is
+        rolled back.
+
+        :param connection: a connection borrowed with :meth:`acquire`
+        :param discard: if True close the connection instead
+        """
+        if not discard:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            created = self.__in_use.pop(id(connection), now)
+            if discard or (self.max_lifetime and now - created > self.max_lifetime):
+                self.__close(connection)
+            else:
+                self.__idle.append((connection, created, now))
+                self.__lock.notify()
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        """Close all the idle connections.
+        """
+        self.__lock.acquire()
+        try:
+            while self.__idle:
+                self.__close(self.__idle.pop()[0])
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """Return the pool metrics as a dict with the number of open, idle
+        and in use connections, the number of connections created and closed
+        so far, the number of checkouts and the total and maximum time spent
+        waiting for a connection in seconds.
+        """
+        self.__lock.acquire()
+        try:
+            return {
+                'size': self.__size,
+                'idle': len(self.__idle),
+                'in_use': len(self.__in_use),
+                'created': self.created,
+                'closed': self.closed,
+                'checkouts': self.checkouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+        finally:
+            self.__lock.release()
+
+
+class Router(object):
+    """Chooses the replica to read from, among the given number of replicas.
+    The replicas are chosen in turn with the `round_robin` policy, or the one
+    used by the fewest contexts with the `least_loaded` policy.
+
+    :param size: number of replicas
+    :param policy: `round_robin` (the default) or `least_loaded`
+    """
+
+    def __init__(self, size, policy='round_robin'):
+        if policy not in ('round_robin', 'least_loaded'):
+            raise ValueError(_('Invalid replica policy %(name)r', name=policy))
+        self.size = size
+        self.policy = policy
+        self.load = [0] * size
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Choose a replica, the caller should :meth:`release` it when done.
+
+        :returns: index of the replica
+        """
+        self.__lock.acquire()
+        try:
+            if self.policy == 'least_loaded':
+                index = self.load.index(min(self.load))
+            else:
+                index = self.__next
+                self.__next = (index + 1) % self.size
+            self.load[index] += 1
+            return index
+        finally:
+            self.__lock.release()
+
+    def release(self, index):
+        """Release the replica chosen with :meth:`acquire`.
+        """
+        self.__lock.acquire()
+        try:
+            self.load[index] -= 1
+        finally:
+            self.__lock.release()
@@ -54,6 +54,11 @@ class Field(object):
     # for internal use only
     _serial = 0
 
+    # position of the field value in the model instances and the dirty bit,
+    # set when the field is added to a model
+    _index = None
+    _bit = 0
+
     _data_type = "char"
 
     def __init__(self, label=None, name=None, default=None, required=False,
@@ -89,12 +94,18 @@ class Field(object):
     def __get__(self, model_instance, model_class):
         if model_instance is None:
             return self
-        return model_instance._values.get(self.name)
+        try:
+            return model_instance._values[self._index]
+        except IndexError: # field added after the instance was created
+            return None
 
     def __set__(self, model_instance, value):
         value = self._validate(model_instance, value)
-        model_instance._values[self.name] = value
-        model_instance._dirty[self.name] = True
+        values = model_instance._values
+        if self._index >= len(values):
+            values.extend([None] * (self._index + 1 - len(values)))
+        values[self._index] = value
+        model_instance._dirty |= self._bit
 
     def python_to_database(self, value):
         """Database representation of this field value.
@@ -118,7 +129,8 @@ class Field(object):
         """Validate the given value. For internal use only, subclasses should
         override `validate` method instead.
 
-        :param model_instance: an instance of the model to which the field is associated
+        :param model_instance: an instance of the model to which the field is
+                               associated, if None model validator is not called
         :param value: the value to be validated
 
         :returns: validated value
@@ -132,7 +144,7 @@ class Field(object):
                 _("Field '%(name)s' is '%(value)s'; must be one of %(selection)s",
                     name=self.name, value=value, selection=self._selection_list))
 
-        if self._validator:
+        if self._validator and model_instance is not None:
             self._validator(model_instance, value)
 
         if value is None:
@@ -12,6 +12,7 @@ import sys, types
 
 from kalapy.db.fields import Field, AutoKey, FieldError
 from kalapy.db.query import Query
+from kalapy.conf import settings
 from kalapy.utils.containers import OrderedDict
 
 
@@ -109,21 +110,58 @@ get_models = cache.get_models
 
 class Options(object):
 
+    #: attributes updated whenever the model is extended
+    _mutable = ('model_class', 'field_list', 'init_plan', 'size')
+
     def __init__(self):
         self.package = None
         self.name = None
         self.table = None
+        self.database = None
         self.fields = OrderedDict()
         self.virtual_fields = OrderedDict()
         self.ref_models = []
         self.unique = []
+        self.indexes = []
+        self.hydrators = {}
+
+        #: the last defined class of the model hierarchy
+        self.model_class = None
+
+        #: tuple of the fields
+        self.field_list = ()
+
+        #: tuple of `(name, field, default, compute)` to initialize instances
+        self.init_plan = ()
+
+        #: number of the field values stored by the instances
+        self.size = 0
 
     @property
     def model(self):
-        return get_model(self.name)
+        return self.model_class
+
+    def prepare(self):
+        """Precompute the field tuples used to create the model instances.
+        Called whenever a field is added to the model.
+
+        The static defaults are stored as is, while the callable defaults and
+        the defaults of the fields overriding :meth:`Field.default_value` are
+        computed for every instance.
+        """
+        static = Field.default_value.im_func
+        plan = []
+        for field in self.fields.values():
+            default, compute = field._default, None
+            if callable(default) or field.default_value.im_func is not static:
+                default, compute = None, field.default_value
+            plan.append((field.name, field, default, compute))
+        self.field_list = tuple(self.fields.values())
+        self.init_plan = tuple(plan)
+        self.size = len(self.fields) + len(self.virtual_fields)
 
     def __setattr__(self, name, value):
-        if getattr(self, name, None) is not None:
+        if name not in self._mutable and getattr(self, name, None) is not None:
             raise AttributeError(
                 _('Attribute %(name)r is already initialized', name=name))
         super(Options, self).__setattr__(name, value)
@@ -143,6 +181,18 @@ def check_reserved_names(attrs):
             raise AttributeError(msg % name)
 
 
+def update_records(instances):
+    """Save the given instances, the instances stored in the same database
+    are saved at once, in the order of the first instance of each database.
+    """
+    from kalapy.db.engines import databases
+    groups = OrderedDict()
+    for obj in instances:
+        groups.setdefault(obj._meta.database, []).append(obj)
+    for name, objs in groups.items():
+        databases[name].update_records(*objs)
+
+
 class ModelType(type):
 
     def __new__(cls, name, bases, attrs):
@@ -159,15 +209,15 @@ class ModelType(type):
 
         check_reserved_names(attrs)
 
+        # instances store their state in slots, see Model
+        slots = attrs.pop('__slots__', ())
+
         # always use the last defined base class in the inheritance chain
         # to maintain linear hierarchy.
 
         meta = getattr(parents[0], '_meta', None) or Options()
 
-        try:
-            parent = cache.get_model(meta.name) if meta.name else None
-        except KeyError:
-            parent = None
+        parent = meta.model_class
 
         if meta.package is None:
             try:
@@ -185,10 +235,13 @@ class ModelType(type):
 
         cls = super_new(cls, name, bases, {
             '_meta': meta,
+            '__slots__': slots,
             '__module__': attrs.pop('__module__')})
 
         # update meta information
         unique = attrs.pop('__unique__', [])
+        indexes = attrs.pop('__indexes__', [])
+        database = attrs.pop('__database__', None)
         if meta.name is None:
             meta_name = name.lower()
             if meta.package:
@@ -196,15 +249,25 @@ class ModelType(type):
             meta.name = meta_name
             meta.table = meta_name.replace(':', '_')
 
+        if meta.database is None:
+            if database is None:
+                database = settings.PACKAGE_OPTIONS.get(
+                    meta.package, {}).get('database', 'default')
+            if database != 'default' and database not in settings.DATABASES:
+                raise ValueError(
+                    _('No such database %(name)r', name=database))
+            meta.database = database
+
         # create primary key field if it is root model
         if not parent:
             cls.add_field(AutoKey())
 
-        # overwrite model class in the cache
+        # overwrite model class in the cache, the hydrators create instances
+        # of the model class
+        meta.model_class = cls
+        meta.hydrators.clear()
         cache.register_model(cls)
 
-        cls._values = None
-
         # sort fields and set attributes to class
         attributes = attrs.items()
         attributes.sort(lambda a, b: cmp(
@@ -238,6 +301,23 @@ class ModelType(type):
                 assert isinstance(field, Field), 'expected a field'
             meta.unique.append(item)
 
+        # prepare indexes, field names prefixed with '-' are in DESC order
+        for item in indexes:
+            item = list(item) if isinstance(item, (list, tuple)) else [item]
+            for i, field in enumerate(item):
+                how = 'ASC'
+                if isinstance(field, basestring):
+                    if field.startswith('-'):
+                        field, how = field[1:], 'DESC'
+                    try:
+                        field = getattr(cls, field)
+                    except:
+                        raise AttributeError(
+                            _('No such field %(name)s.', name=field))
+                assert isinstance(field, Field), 'expected a field'
+                item[i] = (field, how)
+            meta.indexes.append(item)
+
         return cls
 
     def add_field(cls, field, name=None):
@@ -253,6 +333,11 @@ class ModelType(type):
                     name=name, model=cls.__name__))
 
         setattr(cls, name, field)
+        cls._meta.hydrators.clear()
+
+        # position of the field value in the instances
+        field._index = len(cls._meta.fields) + len(cls._meta.virtual_fields)
+        field._bit = 1 << field._index
 
         if getattr(field, 'is_virtual', None):
             cls._meta.virtual_fields[name] = field
@@ -260,6 +345,7 @@ class ModelType(type):
             cls._meta.fields[name] = field
 
         field.__configure__(cls, name)
+        cls._meta.prepare()
 
     def __repr__(cls):
         return "<Model %r: class %s>" % (cls._meta.name, cls.__name__)
@@ -367,16 +453,47 @@ class Model(object):
     >>> u = User(name="some")
     >>> u.save()
 
+    The instances store the field values in a list indexed by the position of
+    the fields and the dirty state as a bitmask, in ``__slots__``, so that
+    large result sets take less memory. The model classes get no instance
+    ``__dict__``, the additional instance attributes should be declared with
+    ``__slots__`` in the class body.
+
+    The fields declared with ``indexed=True`` and the reference fields are
+    indexed by the database. Composite or ordered indexes can be declared
+    with ``__indexes__`` attribute, where field names prefixed with `-` are
+    indexed in descending order::
+
+        class Revision(Model):
+            page = ManyToOne(Page)
+            timestamp = DateTime(default_now=True)
+
+            __indexes__ = [('page', '-timestamp')]
+
+    The models are stored in the `default` database, unless declared with
+    ``__database__`` attribute or with `database` option of the package (see
+    ``settings.PACKAGE_OPTIONS``), naming one of ``settings.DATABASES``::
+
+        class AuditLog(Model):
+            message = String()
+
+            __database__ = 'logs'
+
+    The references to the models stored in other databases are not enforced
+    with foreign keys and are never joined, the referenced instances are
+    loaded by key when accessed. The database cascades don't apply to them.
+
     :param kw: keyword arguments mapping to instance properties.
     """
 
     __metaclass__ = ModelType
 
+    __slots__ = ('_key', '_payload', '_values', '_dirty', '_prefetched', '__weakref__')
+
     def __new__(cls, **kw):
         if cls is Model:
             raise TypeError(_("You can't create instance of Model class"))
-        klass = cache.get_model(cls)
-        return super(Model, cls).__new__(klass)
+        return super(Model, cls).__new__(cls._meta.model_class)
 
     def __init__(self, **kw):
         """Create a new instance of this model.
@@ -388,21 +505,51 @@ class Model(object):
         #: stores database specific information
         self._payload = None
 
-        #: stores record values
-        self._values = {}
+        #: stores record values, indexed by the field positions
+        self._values = [None] * self._meta.size
+
+        #: stores dirty information, bitmask of the field positions
+        self._dirty = 0
 
-        #: stores dirty information
-        self._dirty = {}
+        #: stores prefetched relations
+        self._prefetched = {}
 
-        for field in self.fields().values():
-            if field.name in kw and not field.empty(kw[field.name]):
-                value = kw[field.name]
-            elif field.default is not None:
-                value = field.default
+        for name, field, default, compute in self._meta.init_plan:
+            if name in kw and not field.empty(kw[name]):
+                value = kw[name]
+            elif compute is not None:
+                value = compute()
+                if value is None:
+                    continue
+            elif default is not None:
+                value = default
             else:
                 continue
             field.__set__(self, value)
 
+    def __getstate__(self):
+        # the values by the field names, the field positions change when the
+        # model is extended
+        fields = self._meta.fields.items()
+        return dict(key=self._key, payload=self._payload,
+                    prefetched=self._prefetched,
+                    values=dict([(n, self._values[f._index]) for n, f in fields]),
+                    dirty=[n for n, f in fields if self._dirty & f._bit])
+
+    def __setstate__(self, state):
+        fields = self._meta.fields
+        self._key = state['key']
+        self._payload = state['payload']
+        self._prefetched = state['prefetched']
+        self._values = [None] * self._meta.size
+        self._dirty = 0
+        for name, value in state['values'].items():
+            if name in fields:
+                self._values[fields[name]._index] = value
+        for name in state['dirty']:
+            if name in fields:
+                self._dirty |= fields[name]._bit
+
     @property
     def is_saved(self):
         """Whether the model is saved in database or not.
@@ -416,14 +563,14 @@ class Model(object):
 
         :returns: True if dirty, else False
         """
-        return not self.is_saved or self._dirty
+        return not self.is_saved or self._dirty != 0
 
     def set_dirty(self, dirty=True):
         """Set the instance as dirty or clean.
 
         :param dirty: if True set dirty else set clean
         """
-        self._dirty = dict.fromkeys(self._values, True) if dirty else {}
+        self._dirty = (1 << self._meta.size) - 1 if dirty else 0
 
     def _to_database_values(self, dirty=False):
         """Return values to be stored in database table for this model instance.
@@ -435,11 +582,14 @@ class Model(object):
 
         :returns: a dict, key-value maping of this model's fields.
         """
-        fields = self.fields().values()
+        values = self._values
+        fields = self._meta.field_list
         if dirty:
-            fields = [f for f in fields if f.name in self._dirty]
+            fields = [f for f in fields if self._dirty & f._bit]
 
-        result = dict([(f.name, f.python_to_database(self._values[f.name])) \
+        size = len(values)
+        result = dict([(f.name, f.python_to_database(
+                            values[f._index] if f._index < size else None)) \
                        for f in fields if f.name != 'key'])
         return result
 
@@ -452,20 +602,91 @@ class Model(object):
 
         :returns: an instance of this model
         """
+        from kalapy.db.engines import get_database
+
         values = dict(values)
+        key = values.pop('key', None)
+
+        # return the instance if the record is already loaded
+        identity_map = get_database(cls).identity_map
+        obj = identity_map.get(cls, key)
+        if obj is not None:
+            return obj
 
         obj = cls()
-        obj._key = values.pop('key', None)
+        obj._key = key
         obj._payload = values.pop('_payload', None)
 
-        fields = obj.fields()
+        fields = cls._meta.fields
         for k, v in values.items():
-            values[k] = fields[k].database_to_python(v)
+            field = fields[k]
+            obj._values[field._index] = field.database_to_python(v)
+        obj._dirty = 0
 
-        obj._values.update(values)
-        obj._dirty = {}
+        if key is not None:
+            identity_map.add(obj)
         return obj
 
+    @classmethod
+    def _hydrator(cls, names):
+        """Return a function creating the instances of this model from a list
+        of rows, tuples of values of the given column names, as returned by
+        ``database.fetch_rows``.
+
+        The conversion plan is computed once per column names. The values of
+        the fields not overriding :meth:`Field.database_to_python` are used
+        as is, and the instances are created without calling ``__init__`` as
+        all the values are given.
+
+        :param names: tuple of column names
+
+        :returns: a callable accepting a list of rows
+        """
+        try:
+            return cls._meta.hydrators[names]
+        except KeyError:
+            pass
+
+        from kalapy.db.engines import get_database
+
+        database = get_database(cls)
+        klass = cls._meta.model_class
+        size = cls._meta.size
+        fields = cls._meta.fields
+        index = list(names).index('key')
+        identity = Field.database_to_python.im_func
+        plan = []
+        for i, name in enumerate(names):
+            field = fields.get(name)
+            if field is None or name == 'key':
+                continue
+            convert = field.database_to_python
+            plan.append((i, field._index, None if convert.im_func is identity else convert))
+
+        def hydrate(rows):
+            identity_map = database.identity_map
+            result = []
+            for row in rows:
+                key = row[index]
+                obj = identity_map.get(klass, key)
+                if obj is None:
+                    obj = object.__new__(klass)
+                    obj._key = key
+                    obj._payload = None
+                    obj._dirty = 0
+                    obj._prefetched = {}
+                    obj._values = values = [None] * size
+                    for i, pos, convert in plan:
+                        value = row[i]
+                        values[pos] = value if convert is None else convert(value)
+                    if key is not None:
+                        identity_map.add(obj)
+                result.append(obj)
+            return result
+
+        cls._meta.hydrators[names] = hydrate
+        return hydrate
+
     def _get_related(self):
         """Get the list of all related model instances associated with this
         model instance. Used to get all dirty instances of related model
@@ -480,9 +701,10 @@ class Model(object):
         from reference import IRelation
 
         related = []
+        values = self._values
         for field in self._meta.fields.values():
-            if isinstance(field, IRelation) and field.name in self._values:
-                value = self._values[field.name]
+            if isinstance(field, IRelation) and field._index < len(values):
+                value = values[field._index]
                 if isinstance(value, Model) and value.is_dirty:
                     related.append(value)
         return related
@@ -502,10 +724,8 @@ class Model(object):
         if self.is_saved and not self.is_dirty:
             return self.key
 
-        from kalapy.db.engines import database
-
-        objects = self._get_related() + [self] # first save all related records
-        database.update_records(*objects)
+        # first save all related records
+        update_records(self._get_related() + [self])
 
         return self.key
 
@@ -518,10 +738,94 @@ class Model(object):
         """
         if not self.is_saved:
             raise TypeError(_("Can't delete, instance doesn't exists."))
-        from kalapy.db.engines import database
-        database.delete_records(self)
+        from kalapy.db.engines import get_database
+        get_database(self).delete_records(self)
         self._key = None
 
+    @classmethod
+    def bulk_create(cls, instances, batch_size=None):
+        """Insert the given new instances to the database with as few
+        database statements as possible. Should be preferred over :meth:`save`
+        to import large number of records.
+
+        >>> users = [User(name='user%d' % i) for i in range(10000)]
+        >>> keys = User.bulk_create(users)
+
+        The dirty instances of related models referenced by :class:`ManyToOne`
+        properties are saved first.
+
+        :param instances: sequence of unsaved instances of this model
+        :param batch_size: number of records to be inserted at once, if None
+                           use the database default
+
+        :returns: list of keys
+        :raises:
+            - :class:`TypeError`: if an instance is not of this model
+            - :class:`ValueError`: if an instance is already saved
+            - :class:`DatabaseError`: if instances could not be inserted
+        """
+        instances = list(instances)
+        related = {}
+        for obj in instances:
+            if not isinstance(obj, cls):
+                raise TypeError(
+                    _('%(model)r instances required', model=cls._meta.name))
+            if obj.is_saved:
+                raise ValueError(_("Can't insert, instance already saved."))
+            for value in obj._get_related():
+                related[id(value)] = value
+
+        if not instances:
+            return []
+
+        from kalapy.db.engines import get_database
+
+        if related:
+            update_records(related.values())
+        return get_database(cls).insert_records(instances, batch_size)
+
+    @classmethod
+    def bulk_save(cls, instances, batch_size=None):
+        """Save the given instances to the database with as few database
+        statements as possible. The new instances are inserted as with
+        :meth:`bulk_create` and the changed ones are updated in groups of
+        instances having the same changed fields.
+
+        >>> for user in users:
+        >>>     user.lang = guess_lang(user)
+        >>> User.bulk_save(users)
+
+        :param instances: sequence of instances of this model
+        :param batch_size: number of records to be inserted at once, if None
+                           use the database default
+
+        :returns: list of keys
+        :raises:
+            - :class:`TypeError`: if an instance is not of this model
+            - :class:`DatabaseError`: if instances could not be saved
+        """
+        instances = list(instances)
+        for obj in instances:
+            if not isinstance(obj, cls):
+                raise TypeError(
+                    _('%(model)r instances required', model=cls._meta.name))
+
+        new = [obj for obj in instances if not obj.is_saved]
+        if new:
+            cls.bulk_create(new, batch_size)
+
+        dirty = [obj for obj in instances if obj._dirty]
+        if dirty:
+            related = {}
+            for obj in dirty:
+                for value in obj._get_related():
+                    related[id(value)] = value
+            for obj in dirty:
+                related.pop(id(obj), None)
+            update_records(related.values() + dirty)
+
+        return [obj.key for obj in instances]
+
     @classmethod
     def get(cls, keys):
         """Fetch the instance(s) from the database using the provided keys.
@@ -529,6 +833,9 @@ class Model(object):
         If `keys` is a single value it will return an instance else if `keys`
         is a list of `key` then returns list of instances.
 
+        The instances already loaded with the current database connection are
+        returned without querying the database again.
+
         >>> user = User.get(123)
         >>> isinstance(user, User)
         True
@@ -536,6 +843,9 @@ class Model(object):
         >>> isinstance(users, list):
         True
 
+        A list of instances is returned in the order of the given keys with
+        `None` in place of the missing keys.
+
         :param keys: an key or list of keys
 
         :returns:
@@ -544,14 +854,28 @@ class Model(object):
 
         :raises: :class:`DatabaseError` if instances can't be retrieved.
         """
-        single = False
-        if not isinstance(keys, (list, tuple)):
-            keys = [keys]
-            single = True
-        result = cls.all().filter('key in', keys).fetch(-1)
+        from kalapy.db.engines import get_database
+
+        database = get_database(cls)
+        identity_map = database.identity_map
 
-        if single:
-            return result[0] if result else None
+        if not isinstance(keys, (list, tuple)):
+            obj = identity_map.get(cls, keys)
+            if obj is None:
+                values = database.reader().fetch_record(cls, keys)
+                if values is not None:
+                    obj = cls._from_database_values(values)
+                    identity_map.add(obj, pin=True)
+            return obj
+
+        result = [identity_map.get(cls, k) for k in keys]
+        missing = dict([(str(k), k) for k, obj in zip(keys, result) if obj is None])
+        if missing:
+            loaded = {}
+            for obj in cls.all().filter('key in', missing.values()).fetch(-1):
+                identity_map.add(obj, pin=True)
+                loaded[str(obj.key)] = obj
+            result = [obj or loaded.get(str(k)) for k, obj in zip(keys, result)]
         return result
 
     @classmethod
@@ -578,18 +902,14 @@ class Model(object):
         >>> print users
         [<Object ...> ...]
 
+        Only the given fields are fetched from the database and no model
+        instances are created, reference fields give the referenced keys.
+
         :arg fields: sequence of fields
 
         :returns: :class:`Query` instance
         """
-        def mapper(obj):
-            if not fields:
-                return obj
-            if len(fields) > 1:
-                return tuple([getattr(obj, name) for name in fields])
-            return getattr(obj, fields[0])
-
-        return Query(cls, mapper)
+        return Query(cls, fields=fields)
 
     @classmethod
     def fields(cls):
@@ -10,7 +10,9 @@ from the database.
 
 """
 import re
-from copy import deepcopy
+from itertools import islice
+
+from kalapy.db.fields import FieldError
 
 
 __all__ = ('Query', 'Q')
@@ -18,6 +20,26 @@ __all__ = ('Query', 'Q')
 _FILTER_REGEX = re.compile(
     '^\s*([\w]+)\s+(>|<|>=|<=|==|!=|=|in|not in)\s*$', re.I)
 
+#: cache of parsed filter strings, see :func:`_parse_filter`
+_FILTERS = {}
+
+def _parse_filter(query):
+    """Parse the given filter string to a tuple `(name, op)`. The results
+    are cached as filter strings are mostly literals.
+    """
+    try:
+        return _FILTERS[query]
+    except KeyError:
+        pass
+    try:
+        name, op = _FILTER_REGEX.match(query).groups()
+    except:
+        raise Exception(
+            _('Malformed filter string: %(filter)s', filter=query))
+    result = _FILTERS[query] = (name, op.lower())
+    return result
+
+
 class Q(object):
     """Encapsulates query filters as objects that can then be used to perform
     logical ``OR`` operation using ``|`` operator. For example::
@@ -26,17 +48,30 @@ class Q(object):
 
     The ``AND`` operation is not supported as ``AND`` is the default behaviour
     of multiple :func:`Query.filter` calls.
+
+    The instances are immutable, the items are stored as a tuple of `(name,
+    op, value)` tuples and combining or validating them returns new instances.
     """
     def __init__(self, query, value):
-        try:
-            name, op = _FILTER_REGEX.match(query).groups()
-        except:
-            raise Exception(
-                _('Malformed filter string: %(filter)s', filter=query))
-        self.items = [(name, op, value)]
+        self.items = (_parse_filter(query) + (value,),)
+        self.model = None
+
+    @classmethod
+    def _from_items(cls, items, model=None):
+        q = cls.__new__(cls)
+        q.items = tuple(items)
+        q.model = model
+        return q
 
     def validate(self, model):
-        for i, (name, operator, value) in enumerate(self.items):
+        """Return a new :class:`Q` with the values converted to the database
+        values by the fields of the given model. The values are converted only
+        once, the already validated instance is returned as is.
+        """
+        if self.model is model:
+            return self
+        items = []
+        for name, operator, value in self.items:
             if name not in model._meta.fields:
                 raise AttributeError(
                     _('No such field %(name)r in model %(model)r',
@@ -48,19 +83,12 @@ class Q(object):
                 value = [field.python_to_database(v) for v in value]
             else:
                 value = field.python_to_database(value)
-            self.items[i] = (name, operator, value)
-        return self
-
-    def __deepcopy__(self, meta):
-        n, o, v = self.items[0]
-        q = Q('%s %s' % (n, o), None)
-        q.items = deepcopy(self.items, meta)
-        return q
+            items.append((name, operator, value))
+        return Q._from_items(items, model)
 
     def __or__(self, other):
-        q = deepcopy(self)
-        q.items.extend(other.items)
-        return q
+        model = self.model if self.model is other.model else None
+        return Q._from_items(self.items + other.items, model)
 
     def __repr__(self):
         if len(self.items) == 1:
@@ -68,34 +96,177 @@ class Q(object):
         return "(" + " OR ".join(map(str, self.items)) + ")"
 
 
+def _unique(values):
+    """Remove the duplicates from the given list of values keeping the order.
+    """
+    result = []
+    seen = set()
+    for value in values:
+        try:
+            if value in seen:
+                continue
+            seen.add(value)
+        except TypeError: # not hashable
+            if value in result:
+                continue
+        result.append(value)
+    return result
+
+
+def _equality(item):
+    """Return the field name and the list of values of the given `==` or
+    `in` filter item or None if the item is not an equality.
+    """
+    name, op, value = item
+    if op == '==':
+        return name, [value]
+    if op == 'in':
+        return name, list(value)
+    return None
+
+
+def _make_item(name, values):
+    if len(values) == 1:
+        return (name, '==', values[0])
+    return (name, 'in', values)
+
+
+def _optimize_or(items):
+    """Optimize the items of a single :class:`Q`, the `OR` ed filters.
+
+    :returns: list of items, an empty list if the filters can't match any
+              record or None if they match all the records
+    """
+    result = []
+    equals = {}
+    for item in items:
+        name, op, value = item
+        if op == 'not in' and not value:
+            return None # always true
+        if op == 'in' and not value:
+            continue # always false
+        eq = _equality(item)
+        if eq:
+            if eq[0] in equals:
+                equals[eq[0]].extend(eq[1])
+                continue
+            equals[eq[0]] = eq[1]
+            result.append(eq[0])
+        elif item not in result:
+            result.append(item)
+    return [_make_item(item, _unique(equals[item])) \
+            if isinstance(item, basestring) else item for item in result]
+
+
 class QSet(object):
     """A container of all the :class:`db.Q` instances of a :class:`db.Query`.
 
     It implements :meth:`fetch` and :meth:`count` which in turns calls database
     engine specific version of ``database.fetch`` and ``database.count`` methods.
+
+    The query sets are immutable, :meth:`filter` and :meth:`replace` return new
+    query sets sharing the items with this one.
     """
 
     def __init__(self, model):
         self.model = model
-        self.items = []
+        self.items = ()
         self.order = None
+        self.fields = None
+        self.related = None
+        self.prefetch = None
+
+    def replace(self, **kw):
+        """Return a copy of this query set with the given attributes replaced.
+        """
+        qs = QSet.__new__(QSet)
+        qs.__dict__.update(self.__dict__)
+        qs.__dict__.update(kw)
+        return qs
+
+    def filter(self, q):
+        """Return a copy of this query set with the given :class:`Q` ANDed.
+        """
+        return self.replace(items=self.items + (q.validate(self.model),))
+
+    def optimize(self):
+        """Return an optimized copy of this query set to be passed to the
+        database engines. The `OR` ed equalities of a field are collapsed
+        into ``in`` filters, the duplicate filters are removed and the `AND`
+        ed equalities of a field are intersected.
 
-    def append(self, q):
-        self.items.append(q.validate(self.model))
+        :returns: a :class:`QSet` or None if it can't match any record, like
+                  ``key in []`` or ``x == 1 AND x == 2``
+        """
+        result = []
+        equals = {}
+        for q in self.items:
+            items = _optimize_or(q.items)
+            if items is None:
+                continue
+            if not items:
+                return None
+            eq = _equality(items[0]) if len(items) == 1 else None
+            if eq:
+                if eq[0] in equals:
+                    values = equals[eq[0]]
+                    values[:] = [v for v in values if v in eq[1]]
+                    if not values:
+                        return None
+                    continue
+                equals[eq[0]] = eq[1]
+                result.append(eq[0])
+            elif items not in result:
+                result.append(items)
+
+        qs = []
+        for items in result:
+            if isinstance(items, basestring):
+                items = [_make_item(items, _unique(equals[items]))]
+            qs.append(Q._from_items(items, self.model))
+        return self.replace(items=tuple(qs))
 
     def fetch(self, limit, offset):
-        from kalapy.db.engines import database
-        return database.fetch(self, limit, offset)
+        from kalapy.db.engines import get_database
+        qs = self.optimize()
+        if qs is None:
+            return iter([])
+        return get_database(self.model).reader().fetch(qs, limit, offset)
+
+    def fetch_rows(self, limit, offset):
+        from kalapy.db.engines import get_database
+        qs = self.optimize()
+        if qs is None:
+            return None, iter([])
+        return get_database(self.model).reader().fetch_rows(qs, limit, offset)
+
+    def update(self, values):
+        from kalapy.db.engines import get_database
+        qs = self.optimize()
+        if qs is None:
+            return 0
+        return get_database(self.model).update_where(qs, values)
 
-    def count(self):
-        from kalapy.db.engines import database
-        return database.count(self)
+    def delete(self):
+        from kalapy.db.engines import get_database
+        qs = self.optimize()
+        if qs is None:
+            return 0
+        return get_database(self.model).delete_where(qs)
+
+    def fetch_page(self, limit, cursor):
+        from kalapy.db.engines import get_database
+        qs = self.optimize()
+        if qs is None:
+            return [], None
+        return get_database(self.model).reader().fetch_page(qs, limit, cursor)
 
-    def __deepcopy__(self, meta):
-        qs = QSet(self.model)
-        qs.order = self.order
-        qs.items = deepcopy(self.items, meta)
-        return qs
+    def count(self):
+        from kalapy.db.engines import get_database
+        qs = self.optimize()
+        if qs is None:
+            return 0
+        return get_database(self.model).reader().count(qs)
 
     def __iter__(self):
         return iter(self.items)
@@ -120,7 +291,8 @@ class Query(object):
     be one of ``=, ==, !=, <, >, <=, >=, in, not in``.
 
     Also, ``=`` operator has special meaning, it stands for case-insensitive
-    match (ilike in some DBMS). You should use ``==`` for exact match.
+    match of string fields. You should use ``==`` for exact match. The string
+    fields declared with ``indexed=True`` are indexed for both.
 
     An instance of :class:`Query` can be constructed by passing :class:`Model`
     subclass as first argument. The contructor also accept a callable as a second
@@ -130,11 +302,20 @@ class Query(object):
     >>> print names
     ['some', 'someone', 'some1']
 
+    If field names are given, only those fields are fetched from the database
+    and the result set will contain tuple of the field values (or just the
+    value if only one field is given) instead of model instances.
+
+    >>> names = Query(User, fields=('name',)).filter('name =', 'some').fetch(-1)
+    >>> print names
+    ['some', 'someone', 'some1']
+
     :param model: a model, subclass of :class:`Model`
     :param mapper: a `callback` function to map query result
+    :param fields: sequence of field names to be fetched
     """
 
-    def __init__(self, model, mapper=None):
+    def __init__(self, model, mapper=None, fields=None):
         """Create a new instance of :class:`Query` for the given `model`. The result
         set will be mapped with the given mapper.
         """
@@ -144,6 +325,103 @@ class Query(object):
         self.__model = model
         self.__mapper = mapper
         self.__qset = QSet(model)
+        self.__result = None
+
+        if fields:
+            for name in fields:
+                if name not in model._meta.fields:
+                    raise AttributeError(
+                        _('No such field %(name)r in model %(model)r',
+                            name=name, model=model._meta.name))
+            self.__qset = self.__qset.replace(fields=tuple(fields))
+
+    def __convert(self, values):
+        """Convert the values fetched from the database to a model instance or
+        tuple of values if fields are given.
+        """
+        names = self.__qset.fields
+        if names:
+            fields = self.__model._meta.fields
+            result = tuple([fields[n].database_to_python(values[n]) for n in names])
+            if len(result) == 1:
+                return result[0]
+            return result
+        return self.__model._from_database_values(values)
+
+    def __hydrator(self, names):
+        """Return a function converting a list of rows, tuples of values of
+        the given column names, to model instances or tuple of values if
+        fields are given.
+        """
+        fields = self.__qset.fields
+        if not fields:
+            return self.__model._hydrator(names)
+        converters = [self.__model._meta.fields[n].database_to_python for n in names]
+        if len(converters) == 1:
+            convert = converters[0]
+            return lambda rows: [convert(row[0]) for row in rows]
+        plan = list(enumerate(converters))
+        return lambda rows: [tuple([f(row[i]) for i, f in plan]) for row in rows]
+
+    def __load(self, rows, names=None):
+        """Convert the given rows to the result set, load the prefetched
+        relations and apply the mapper if any.
+
+        :param rows: list of dict of name, value mappings or tuples of values
+                     if column names are given
+        :param names: column names of the rows
+        """
+        if names is None:
+            result = map(self.__convert, rows)
+        else:
+            result = self.__hydrator(names)(rows)
+        if self.__qset.prefetch and not self.__qset.fields:
+            self.__prefetch(result)
+        if self.__mapper:
+            return map(self.__mapper, result)
+        return result
+
+    def __prefetch(self, instances):
+        """Load the relations given to :meth:`prefetch` for all the given
+        instances, with one query per relation.
+        """
+        from kalapy.db.reference import OneToMany
+        if not instances:
+            return
+        keys = [obj.key for obj in instances]
+        parents = dict([(obj.key, obj) for obj in instances])
+        for name in self.__qset.prefetch:
+            field = self.__model._meta.virtual_fields[name]
+            groups = dict([(k, []) for k in keys])
+            if isinstance(field, OneToMany):
+                reverse = field.reverse_name
+                ref_field = field.reference._meta.fields[reverse]
+                index = ref_field._index
+                q = field.reference.all().filter('%s in' % reverse, keys)
+                for obj in q:
+                    # the instances from the identity map may hold the
+                    # parent instance instead of the key
+                    parent = parents[ref_field.python_to_database(obj._values[index])]
+                    obj._values[index] = parent
+                    groups[parent.key].append(obj)
+            else:
+                source = field.m2m._meta.fields[field.source]
+                q = field.m2m.all().filter('%s in' % field.source, keys) \
+                                   .select_related(field.target)
+                for link in q:
+                    key = source.python_to_database(link._values[source._index])
+                    groups[key].append(getattr(link, field.target))
+            for obj in instances:
+                obj._prefetched[name] = groups[obj.key]
+
+    def _from_result(self, result):
+        """Answer this query from the given list of already loaded instances
+        instead of querying the database. Used by the reference sets to serve
+        the prefetched relations. Filtering the query returns a new query
+        which hits the database again.
+        """
+        self.__result = list(result)
+        return self
 
     def filter(self, *args):
         """Return a new :class:`Query` instance with the given query ANDed with
@@ -174,8 +452,8 @@ class Query(object):
             q = Q(*args)
         else:
             q = args[0]
-        query = deepcopy(self)
-        query.__qset.append(q)
+        query = Query(self.__model, self.__mapper)
+        query.__qset = self.__qset.filter(q)
         return query
 
     def order(self, spec):
@@ -187,9 +465,74 @@ class Query(object):
         :param spec: field name, if prefixed with `-` order by DESC else ASC
         """
         assert isinstance(spec, basestring)
-        self.__qset.order = (spec, 'ASC')
+        order = (spec, 'ASC')
         if spec.startswith('-'):
-            self.__qset.order = (spec[1:], 'DESC')
+            order = (spec[1:], 'DESC')
+        self.__qset = self.__qset.replace(order=order)
+        if self.__result is not None:
+            name, how = order
+            self.__result.sort(key=lambda obj: getattr(obj, name),
+                               reverse=how == 'DESC')
+        return self
+
+    def select_related(self, *fields):
+        """Fetch the instances referenced by the given :class:`ManyToOne` or
+        :class:`OneToOne` fields with the same query, instead of querying for
+        them when the result set is loaded. Nested references can be given
+        with dotted names.
+
+        >>> q = Query(Revision).select_related('page', 'page.owner')
+        >>> for rev in q.fetch(20):
+        >>>     print rev.page.name, rev.page.owner.name
+
+        Engines not supporting joins will ignore it, as well as the references
+        to the models stored in other databases.
+
+        :param fields: names of the reference fields
+        :raises: :class:`FieldError` if a field is not a reference field
+        """
+        from kalapy.db.reference import ManyToOne
+        related = set(self.__qset.related or ())
+        for path in fields:
+            model = self.__model
+            names = path.split('.')
+            for i, name in enumerate(names):
+                field = model._meta.fields.get(name)
+                if not isinstance(field, ManyToOne):
+                    raise FieldError(
+                        _('No such reference field %(name)r in model %(model)r',
+                            name=name, model=model._meta.name))
+                if field.reference._meta.database != model._meta.database:
+                    break
+                model = field.reference
+                related.add('.'.join(names[:i+1]))
+        self.__qset = self.__qset.replace(related=tuple(sorted(related)))
+        return self
+
+    def prefetch(self, *fields):
+        """Load the instances of the given :class:`OneToMany` or
+        :class:`ManyToMany` fields for the whole result set at once, with a
+        single query per field, instead of querying for them for every
+        instance. The reference sets of the loaded instances will then be
+        answered from memory.
+
+        >>> q = Query(Page).prefetch('revisions', 'tags')
+        >>> for page in q.fetch(20):
+        >>>     print page.name, page.revisions.all().count()
+
+        :param fields: names of the one-to-many or many-to-many fields
+        :raises: :class:`FieldError` if a field is not such a field
+        """
+        from kalapy.db.reference import OneToMany, ManyToMany
+        prefetch = set(self.__qset.prefetch or ())
+        for name in fields:
+            field = self.__model._meta.virtual_fields.get(name)
+            if not isinstance(field, (OneToMany, ManyToMany)):
+                raise FieldError(
+                    _('No such one-to-many or many-to-many field %(name)r in model %(model)r',
+                        name=name, model=self.__model._meta.name))
+            prefetch.add(name)
+        self.__qset = self.__qset.replace(prefetch=tuple(sorted(prefetch)))
         return self
 
     def fetch(self, limit, offset=0):
@@ -209,11 +552,49 @@ class Query(object):
         :returns: list of model instances or content if mapper is applied
         :rtype: list
         """
-        result = map(self.__model._from_database_values,
-                        self.__qset.fetch(limit, offset))
-        if self.__mapper:
-            return map(self.__mapper, result)
-        return result
+        if self.__result is not None:
+            stop = None if limit == -1 else offset + limit
+            result = self.__result[offset:stop]
+            if self.__mapper:
+                return map(self.__mapper, result)
+            return result
+        names, rows = self.__qset.fetch_rows(limit, offset)
+        return self.__load(rows, names)
+
+    def fetch_page(self, limit, cursor=None):
+        """Fetch the given number of records following the position given by
+        the cursor. Unlike :meth:`fetch` with an offset, the cost doesn't
+        depend on the page number, so it should be preferred to paginate over
+        large result sets.
+
+        The records are ordered by the field given to :meth:`order` with
+        ``key`` as tie breaker. The order field should not have ``None``
+        values.
+
+        >>> q = Query(User).order('-age')
+        >>> users, cursor = q.fetch_page(20)
+        >>> more_users, cursor = q.fetch_page(20, cursor)
+
+        :param limit: number of records to be fetch
+        :param cursor: an opaque cursor returned by previous call, if None
+                       fetch the first page
+
+        :returns: a tuple of list of model instances (or content if mapper
+                  is applied) and a cursor string for the next page or None
+                  if there are no more records
+        :rtype: tuple
+        """
+        result, cursor = self.__qset.fetch_page(limit, cursor)
+        return self.__load(result), cursor
+
+    def fetch_after(self, cursor, limit):
+        """Fetch the given number of records following the position given by
+        the cursor. See :meth:`fetch_page` for more details.
+
+        :returns: list of model instances or content if mapper is applied
+        :rtype: list
+        """
+        return self.fetch_page(limit, cursor)[0]
 
     def fetchone(self, offset=0):
         """Fetch a single record from the query object with given offset.
@@ -236,6 +617,8 @@ class Query(object):
     def count(self):
         """Return the number of records in the query object.
         """
+        if self.__result is not None:
+            return len(self.__result)
         return self.__qset.count()
 
     def delete(self):
@@ -246,9 +629,10 @@ class Query(object):
         >>> Query(User).filter('name =', 'some').delete()
 
         will delete all the User records matching the name like 'some'
+
+        :returns: number of records deleted
         """
-        for obj in self.fetch(-1):
-            obj.delete()
+        return self.__qset.delete()
 
     def update(self, **kw):
         """Update all the matched records with the given keywords mapping to
@@ -261,13 +645,23 @@ class Query(object):
         will update all the User records matching name like 'some' by updating
         `lang` to `en_EN`.
 
+        The records are updated with a single database statement, so the
+        model instances are not loaded. The values are still validated by
+        the respective fields, but model level ``validate_<name>`` methods
+        are not called.
+
         :keyword kw: keyword args mapping to the field properties
+
+        :returns: number of records updated
+        :raises: :class:`ValidationError`, :class:`DatabaseError`
         """
-        for obj in self.fetch(-1):
-            for k, v in kw.items():
-                if k in obj._meta.fields:
-                    setattr(obj, k, v)
-            obj.save()
+        fields = self.__model._meta.fields
+        values = {}
+        for k, v in kw.items():
+            if k in fields and k != 'key':
+                field = fields[k]
+                values[k] = field.python_to_database(field._validate(None, v))
+        return self.__qset.update(values)
 
     def __getitem__(self, arg):
         if isinstance(arg, (int, long)):
@@ -281,17 +675,28 @@ class Query(object):
                 _('Only integer indices are supported.'))
 
     def __iter__(self):
-        offset = -1
-        try:
-            while True:
-                offset += 1
-                yield self.fetch(1, offset)[0]
-        except Exception:
-            pass
+        """Iterate over all the matched records. The records are streamed
+        from a single database query, so it is safe to iterate over large
+        result sets. The prefetched relations are loaded in batches of 100
+        records.
+        """
+        if self.__result is not None:
+            for obj in self.fetch(-1):
+                yield obj
+            return
+        names, rows = self.__qset.fetch_rows(-1, 0)
+        rows = iter(rows)
+        while True:
+            result = self.__load(list(islice(rows, 100)), names)
+            if not result:
+                break
+            for obj in result:
+                yield obj
 
     def __deepcopy__(self, meta):
+        # the query sets are immutable, so they can be shared
         q = Query(self.__model, self.__mapper)
-        q.__qset = deepcopy(self.__qset, meta)
+        q.__qset = self.__qset
         return q
 
     def __repr__(self):
@@ -15,6 +15,25 @@ from kalapy.db.model import ModelType, Model, cache
 __all__ = ('ManyToOne', 'OneToOne', 'OneToMany', 'ManyToMany')
 
 
+class ReferenceKey(object):
+    """A descriptor to access the key of the instance referenced by a
+    :class:`ManyToOne` field without loading the instance.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+        return self.field.python_to_database(
+            Field.__get__(self.field, model_instance, model_class))
+
+    def __set__(self, model_instance, value):
+        raise AttributeError(
+            _('%(name)r is a read-only reference key.', name='%s_key' % self.field.name))
+
+
 class IRelation(Field):
     """This class defines an interface method prepare which will called
     once all defined models are loaded. So the field would have chance
@@ -50,7 +69,10 @@ class IRelation(Field):
     def reference(self):
         """Returns the reference class.
         """
-        return cache.get_model(self._reference)
+        ref = self._reference
+        if not isinstance(ref, ModelType):
+            ref = self._reference = cache.get_model(ref)
+        return ref._meta.model_class
 
     @property
     def is_virtual(self):
@@ -88,6 +110,10 @@ class ManyToOne(IRelation):
     A reverse lookup field of type :class:`OneToMany` named `address_set` will be
     automatically created in class `User`.
 
+    The referenced instance is loaded on first access. The key of the
+    referenced instance can be accessed without loading it with a read-only
+    property named `user_key`.
+
     :param reference: reference model class
     :param reverse_name: name of the reverse lookup field in the referenced model
     :param cascade: None = set null, False = restrict and True = cascade
@@ -103,6 +129,12 @@ class ManyToOne(IRelation):
         self.reverse_name = reverse_name
         self.cascade = cascade
 
+    def __configure__(self, model_class, name):
+        super(ManyToOne, self).__configure__(model_class, name)
+        key_name = '%s_key' % name
+        if not hasattr(model_class, key_name):
+            setattr(model_class, key_name, ReferenceKey(self))
+
     def prepare(self, model_class, reverse_name=None, reverse_class=None):
 
         # check for recursive dependency and update dependency info
@@ -132,13 +164,20 @@ class ManyToOne(IRelation):
         self.reference.add_field(f)
 
     def __get__(self, model_instance, model_class):
-        return super(ManyToOne, self).__get__(model_instance, model_class)
+        if model_instance is None:
+            return self
+        value = super(ManyToOne, self).__get__(model_instance, model_class)
+        if value is None or isinstance(value, Model):
+            return value
+        # load the referenced instance on first access
+        value = model_instance._values[self._index] = self.reference.get(value)
+        return value
 
     def __set__(self, model_instance, value):
         if value is not None and not isinstance(value, self.reference):
             raise ValueError(
                 _('ManyToOne field %(name)r value should be an instance of %(model)r',
-                    name=self.name, model=self._reference.__name__))
+                    name=self.name, model=self.reference.__name__))
         super(ManyToOne, self).__set__(model_instance, value)
 
     def python_to_database(self, value):
@@ -147,10 +186,11 @@ class ManyToOne(IRelation):
         return value
 
     def database_to_python(self, value):
-        if value is None:
-            return value
-        if not isinstance(value, self.reference):
-            return self.reference.get(value)
+        if isinstance(value, dict): # fetched with the same query
+            if value.get('key') is None:
+                return None
+            return self.reference._from_database_values(value)
+        # keep the key, the instance is loaded on first access
         return value
 
 
@@ -208,15 +248,14 @@ class O2ORel(IRelation):
         if model_instance is None:
             return self
 
-        try: # if already fetched
-            return model_instance._values[self.name]
-        except:
-            pass
+        value = super(O2ORel, self).__get__(model_instance, model_class)
+        if value is not None: # if already fetched
+            return value
 
         if model_instance.is_saved:
             value = self.reference.all().filter(
                 '%s ==' % self.reverse_name, model_instance.key).fetch(1)[0]
-            model_instance._values[self.name] = value
+            model_instance._values[self._index] = value
             return value
 
         return None
@@ -233,7 +272,7 @@ class O2ORel(IRelation):
         super(O2ORel, self).__set__(model_instance, value)
 
         # this is virtual field, so mark it clean
-        del model_instance._dirty[self.name]
+        model_instance._dirty &= ~self._bit
 
         if getattr(value, self.reverse_name, None) != model_instance:
             setattr(value, self.reverse_name, model_instance)
@@ -268,8 +307,11 @@ class O2MSet(object):
         """Returns a :class:`Query` object pre-filtered to return related objects.
         """
         self.__check()
-        return self.__ref.all().filter('%s ==' % (self.__field.reverse_name),
+        q = self.__ref.all().filter('%s ==' % (self.__field.reverse_name),
                 self.__obj.key)
+        if self.__field.name in self.__obj._prefetched:
+            q._from_result(self.__obj._prefetched[self.__field.name])
+        return q
 
     def add(self, *objs):
         """Add new instances to the reference set.
@@ -277,6 +319,7 @@ class O2MSet(object):
         :raises:
             TypeError: if any given object is not an instance of referenced model
         """
+        self.__obj._prefetched.pop(self.__field.name, None)
         for obj in self.__check(*objs):
             setattr(obj, self.__field.reverse_name, self.__obj)
             obj.save()
@@ -294,9 +337,10 @@ class O2MSet(object):
                     name=self.__field.name))
 
         self.__check(*objs)
+        self.__obj._prefetched.pop(self.__field.name, None)
 
-        from kalapy.db.engines import database
-        database.delete_records(*objs)
+        from kalapy.db.engines import get_database
+        get_database(self.__ref).delete_records(*objs)
 
     def clear(self):
         """Removes all referenced instances from the reference set.
@@ -313,7 +357,11 @@ class O2MSet(object):
                 _("objects can't be removed from %(name)r, delete the objects instead.",
                     name=self.__field.name))
 
-        from kalapy.db.engines import database
+        self.__obj._prefetched.pop(self.__field.name, None)
+
+        from kalapy.db.engines import get_database
+
+        database = get_database(self.__ref)
 
         # instead of removing records at once remove them in bunches
         l = 100
@@ -351,12 +399,15 @@ class M2MSet(object):
         """Returns a :class:`Query` object pre-filtered to return related objects.
         """
         self.__check()
+        if self.__field.name in self.__obj._prefetched:
+            keys = [o.key for o in self.__obj._prefetched[self.__field.name]]
+            return self.__ref.all().filter('key in', keys)._from_result(
+                self.__obj._prefetched[self.__field.name])
         #XXX: think about a better solution
         # Use nested SELECT or JOIN, but some backends might not support that
         keys = self.__m2m.select(self.__field.target) \
                          .filter(self.__source_eq, self.__obj.key) \
                          .fetch(-1)
-        keys = [o.key for o in keys]
         return self.__ref.all().filter('key in', keys)
 
     def add(self, *objs):
@@ -367,12 +418,12 @@ class M2MSet(object):
             - `ValueError`: if any of the given object is not saved
         """
         keys = [obj.key for obj in self.__check(*objs) if obj.key]
+        self.__obj._prefetched.pop(self.__field.name, None)
 
         if keys:
             existing = self.__m2m.select(self.__field.target) \
                                  .filter(self.__source_eq, self.__obj.key) \
                                  .fetch(-1)
-            existing = [o.key for o in existing]
             objs = [o for o in objs if o.key not in existing]
 
         for obj in objs:
@@ -390,9 +441,10 @@ class M2MSet(object):
             - `TypeError`: if any given object is not an instance of referenced model
         """
         self.__check(*objs)
+        self.__obj._prefetched.pop(self.__field.name, None)
 
-        from kalapy.db.engines import database
-        database.delete_records(*objs)
+        from kalapy.db.engines import get_database
+        get_database(self.__ref).delete_records(*objs)
 
     def clear(self):
         """Removes all referenced instances from the reference set.
@@ -400,7 +452,11 @@ class M2MSet(object):
         if not self.__obj.is_saved:
             return
 
-        from kalapy.db.engines import database
+        self.__obj._prefetched.pop(self.__field.name, None)
+
+        from kalapy.db.engines import get_database
+
+        database = get_database(self.__ref)
 
         # instead of removing records at once remove them in bunches
         l = 100
@@ -546,7 +602,8 @@ class ManyToMany(IRelation):
             name = '%s_%s' % (self.source, self.name)
 
             cls = ModelType(name, (Model,), {
-                '__module__': model_class.__module__
+                '__module__': model_class.__module__,
+                '__database__': model_class._meta.database
             })
 
             kw = dict(required=True, indexed=True, cascade=self.cascade)
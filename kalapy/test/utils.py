@@ -90,7 +90,7 @@ def run_tests(names, verbosity=1):
     :param verbosity: verbose level
     """
 
-    from kalapy.db.engines import database
+    from kalapy.db.engines import database, databases
     from kalapy.conf.loader import loader
 
     database.connect()
@@ -101,7 +101,8 @@ def run_tests(names, verbosity=1):
             suite.addTest(build_suite(name))
         result = unittest.TextTestRunner(verbosity=verbosity).run(suite)
     finally:
-        database.close()
+        for conn in databases.values():
+            conn.close()
 
     return len(result.failures) + len(result.errors)
 
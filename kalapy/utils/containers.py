@@ -7,6 +7,12 @@ This module implements few container datastructures like `OrderedDict`.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+
 class OrderedDict(dict):
 
     def __init__(self, *args, **kw):
@@ -90,3 +96,81 @@ class OrderedDict(dict):
 
     def __repr__(self):
         return '{%s}' % ', '.join(['%r: %r' % (k, v) for k, v in self.items()])
+
+
+class LRUCache(object):
+    """A thread safe mapping that holds at most `size` items, discarding the
+    least recently used items first. It also keeps track of cache hits and
+    misses, which can be used to tune the cache size.
+
+    :param size: maximum number of items to be cached
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = _threading.Lock()
+        # circular doubly linked list of [prev, next, key, value] nodes
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        """Get the cached value for the given key and mark it as the most
+        recently used item. Returns `default` if the key is not cached.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                node = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            prev, next = node[0], node[1]
+            prev[1], next[0] = next, prev
+            root = self._root
+            last = root[0]
+            node[0], node[1] = last, root
+            last[1] = root[0] = node
+            return node[3]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            root = self._root
+            if key in self._data:
+                node = self._data.pop(key)
+                node[0][1], node[1][0] = node[1], node[0]
+            elif len(self._data) >= self.size:
+                oldest = root[1]
+                oldest[0][1], oldest[1][0] = oldest[1], oldest[0]
+                del self._data[oldest[2]]
+            last = root[0]
+            last[1] = root[0] = self._data[key] = [last, root, key, value]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Remove all the cached items and reset the counters.
+        """
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __repr__(self):
+        return '<LRUCache size=%d items=%d hits=%d misses=%d>' % (
+            self.size, len(self._data), self.hits, self.misses)
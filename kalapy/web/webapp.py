@@ -111,6 +111,9 @@ class Package(object):
     #: view functions, shared among all the packages
     views = {}
 
+    #: read-only flags of the endpoints, shared among all the packages
+    readonly = {}
+
     def __init__(self, name, path=None):
 
         if path is None:
@@ -165,6 +168,10 @@ class Package(object):
         will be automatically generated from the function name. Also, the
         endpoint will be prefixed with current package name.
 
+        If `readonly` option is given, the requests to the endpoint run with
+        the database in read-only mode (or not, if False) regardless of the
+        ``settings.DATABASE_READONLY_METHODS``.
+
         Other options are similar to :class:`werkzeug.routing.Rule` constructor.
         """
         if endpoint is None:
@@ -178,6 +185,10 @@ class Package(object):
         if not self.is_main:
             endpoint = '%s.%s' % (self.name, endpoint)
 
+        readonly = options.pop('readonly', None)
+        if readonly is not None:
+            self.readonly[endpoint] = readonly
+
         options.setdefault('methods', ('GET',))
         options['endpoint'] = endpoint
 
@@ -333,6 +344,12 @@ class Application(Package):
         request.view_args = args
         request.view_func = func = self.views[endpoint]
 
+        readonly = self.readonly.get(endpoint)
+        if readonly is None:
+            readonly = request.method in settings.DATABASE_READONLY_METHODS
+        if readonly:
+            signals.send('request-readonly')
+
         try:
             return self.make_response(func(**args))
         except Exception, e:
@@ -393,6 +410,9 @@ def route(rule, **options):
     :param methods: a list of http methods this rule is limited to like
                    (``'GET'``, ``'POST'``, etc). By default a rule is
                    limited to ``'GET'`` (and implicitly ``'HEAD'``).
+    :param readonly: if True the requests run with the database in read-only
+                     mode, if False never, by default the mode depends on
+                     ``settings.DATABASE_READONLY_METHODS``.
     :param options: other options to be forwarded to the underlying
                     :class:`werkzeug.routing.Rule` object.
     """
@@ -2,7 +2,7 @@ from kalapy import db
 
 
 class User(db.Model):
-    name = db.String(size=100, required=True)
+    name = db.String(size=100, required=True, indexed=True)
     lang = db.String(size=6, selection=[('en_EN', 'English'),
                                         ('fr_FR', 'French'),
                                         ('de_DE', 'German')])
@@ -50,6 +50,8 @@ class Article(db.Model):
     text = db.Text()
     author = db.ManyToOne(User)
 
+    __indexes__ = [('author', '-pub_date')]
+
 class Comment(db.Model):
     title = db.String(size=100, required=True)
     pub_date = db.DateTime(default_now=True)
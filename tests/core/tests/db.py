@@ -20,6 +20,28 @@ class DBTest(TestCase):
             return
         self.assertTrue(database.exists_table(Article))
 
+    def test_create_indexes(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        indexes = dict(database.get_indexes(Article))
+        self.assertEqual(indexes, {
+            'core_article_author_idx': ('"author" ASC',),
+            'core_article_author_pub_date_desc_idx': ('"author" ASC', '"pub_date" DESC'),
+        })
+        indexes = dict(database.get_indexes(User))
+        self.assertTrue('core_user_name_idx' in indexes)
+        self.assertTrue('core_user_name_nocase_idx' in indexes)
+        for name in indexes:
+            self.assertTrue(database.exists_index(User, name))
+        self.assertEqual(database.create_indexes(Article), [])
+
+        # text columns indexed by prefix, as required by MySQL
+        from kalapy.db.engines import Database
+        db2 = Database(name=settings.DATABASE_NAME)
+        db2.text_index_prefix = 255
+        self.assertEqual(db2.get_index_column(UserNotes.notes, 'DESC'), '"notes"(255) DESC')
+        self.assertEqual(db2.get_index_column(User.name, 'ASC'), '"name" ASC')
+
     def test_drop_table(self):
         if settings.DATABASE_ENGINE == "gae":
             return
@@ -47,6 +69,16 @@ class DBTest(TestCase):
         a = Article.get(a1.key)
         self.assertTrue(a.title != 'title')
 
+        if settings.DATABASE_ENGINE == "gae":
+            return
+
+        # the records stay dirty if the update fails
+        g1, g2, g3 = Group(name='g1'), Group(name='g2'), Group(name='g3')
+        database.update_records(g1, g2, g3)
+        g1.name, g2.name = 'g3', 'g4'
+        self.assertRaises(db.IntegrityError, database.update_records, g1, g2)
+        self.assertTrue(g1.is_dirty and g2.is_dirty)
+
     def test_delete_records(self):
         a1 = Article(title='sometitle')
         k1 = a1.save()
@@ -85,6 +117,145 @@ class DBTest(TestCase):
         res = Article.all().count()
         self.assertTrue(res == 2)
 
+    def test_statement_cache(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        Article.all().filter('title in', ['a', 'b']).fetch(-1)
+        hits, misses = database.statements.hits, database.statements.misses
+
+        # same shape, only parameters differ
+        Article.all().filter('title in', ['c', 'd']).fetch(-1)
+        self.assertEqual(database.statements.hits, hits + 1)
+        self.assertEqual(database.statements.misses, misses)
+
+        # different number of items in the IN list
+        Article.all().filter('title in', ['a', 'b', 'c']).fetch(-1)
+        self.assertEqual(database.statements.misses, misses + 1)
+
+    def test_pool(self):
+        import sqlite3, time
+        from kalapy.db.engines.utils import Pool, PoolError
+
+        def check(conn):
+            conn.execute('SELECT 1')
+
+        pool = Pool(lambda: sqlite3.connect(':memory:'), check=check,
+                    max_size=2, timeout=0.01)
+        c1 = pool.acquire()
+        c2 = pool.acquire()
+        self.assertRaises(PoolError, pool.acquire)
+        pool.release(c1)
+        self.assertTrue(pool.acquire() is c1)
+
+        # broken connections are replaced
+        c2.close()
+        pool.release(c2)
+        c3 = pool.acquire()
+        self.assertTrue(c3 is not c2)
+
+        pool.release(c1, discard=True)
+        pool.release(c3)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['in_use']), (1, 1, 0))
+        self.assertEqual((stats['created'], stats['closed'], stats['checkouts']), (3, 2, 4))
+
+        pool.max_lifetime = 0.001
+        time.sleep(0.01)
+        self.assertTrue(pool.acquire() is not c3)
+
+    def test_lazy_connect(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        from kalapy.db.engines import Database
+        db = Database(name=settings.DATABASE_NAME,
+                      host=settings.DATABASE_HOST,
+                      port=settings.DATABASE_PORT,
+                      user=settings.DATABASE_USER,
+                      password=settings.DATABASE_PASSWORD)
+        db.commit()
+        db.rollback()
+        self.assertEqual(db.connection, None)
+        db.cursor()
+        self.assertTrue(db.connection is not None)
+        db.close()
+        self.assertEqual(db.connection, None)
+
+
+    def test_readonly(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        from kalapy.db.engines import Database, DatabaseError
+        db = Database(name=settings.DATABASE_NAME,
+                      host=settings.DATABASE_HOST,
+                      port=settings.DATABASE_PORT,
+                      user=settings.DATABASE_USER,
+                      password=settings.DATABASE_PASSWORD)
+        db.set_readonly(True)
+        self.assertEqual(db.connection, None)
+        cursor = db.cursor()
+        cursor.execute('SELECT 1')
+        self.assertRaises(DatabaseError, cursor.execute,
+            'CREATE TABLE "readonly_test" ("value" INTEGER)')
+        db.commit()
+        db.rollback()
+        db.close()
+        self.assertFalse(db.readonly)
+
+        # large in filters still work, with temporary tables
+        database.set_readonly(True)
+        try:
+            keys = [a.key for a in Article.all().fetch(-1)]
+            q = Article.all().filter('key in', keys + range(1000, 1000 + database.max_in))
+            self.assertEqual(q.count(), len(keys))
+        finally:
+            database.set_readonly(False)
+
+
+    def test_replicas(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        from kalapy.db.engines import Connection
+        from kalapy.db.engines.utils import Router
+        from kalapy.db.query import QSet
+
+        router = Router(3)
+        self.assertEqual([router.acquire() for i in range(4)], [0, 1, 2, 0])
+        router = Router(3, 'least_loaded')
+        router.release(router.acquire())
+        self.assertEqual([router.acquire() for i in range(4)], [0, 1, 2, 0])
+
+        # use the test database as replicas
+        params = dict(name=settings.DATABASE_NAME,
+                      host=settings.DATABASE_HOST,
+                      port=settings.DATABASE_PORT,
+                      user=settings.DATABASE_USER,
+                      password=settings.DATABASE_PASSWORD)
+        conn = Connection(params, [{}, {}], 'least_loaded')
+        replica = conn.reader()
+        self.assertTrue(conn.reader() is replica)
+        self.assertEqual(conn.router.load, [1, 0])
+        self.assertEqual(replica.count(QSet(Article)), Article.all().count())
+
+        # read your writes
+        conn.update_where(QSet(Article).filter(db.Q('title =', '')), {})
+        self.assertTrue(conn.reader() is not replica)
+        self.assertTrue(conn.reader() is conn.reader())
+        conn.close()
+        self.assertEqual(conn.router.load, [0, 0])
+
+        conn = Connection(params, [{}], sticky=False)
+        self.assertTrue(conn.run_in_transaction(conn.reader) is not conn.reader())
+        conn.close()
+
+        # the transactions of the default database cover the other databases
+        from kalapy.db.engines import databases, run_in_transaction
+        databases['replicated'] = conn
+        try:
+            self.assertTrue(run_in_transaction(conn.reader) is not conn.reader())
+        finally:
+            del databases['replicated']
+            conn.close()
+
 
 class ModelTest(TestCase):
 
@@ -107,6 +278,83 @@ class ModelTest(TestCase):
             self.assertTrue(u.do_something() == 4)
 
 
+    def test_model_defaults(self):
+        import datetime
+        a1 = Account()
+        a2 = Account(create_date=datetime.datetime(2001, 1, 1))
+        self.assertTrue(isinstance(a1.create_date, datetime.datetime))
+        self.assertEqual(a2.create_date, datetime.datetime(2001, 1, 1))
+        self.assertEqual(a1.expire_date, None)
+        self.assertTrue(a1.is_dirty)
+        self.assertTrue(User._meta.model_class is User().__class__)
+
+    def test_model_slots(self):
+        u1 = User(name="slots")
+        self.assertFalse(hasattr(u1, '__dict__'))
+        self.assertRaises(AttributeError, setattr, u1, 'foo', 1)
+        self.assertEqual(len(u1._values), User._meta.size)
+        self.assertEqual(u1._dirty, User.name._bit)
+        self.assertEqual(u1._to_database_values(True), {'name': 'slots'})
+
+        u1.save()
+        self.assertFalse(u1.is_dirty)
+        u1.lang = 'en_EN'
+        self.assertEqual(u1._to_database_values(True), {'lang': 'en_EN'})
+        u1.set_dirty()
+        self.assertEqual(sorted(u1._to_database_values(True)),
+                         sorted([n for n in User._meta.fields if n != 'key']))
+
+    def test_model_pickle(self):
+        import pickle
+        u1 = User(name="pickled")
+        u1.save()
+        u1.lang = 'fr_FR'
+        for protocol in (0, 2):
+            u2 = pickle.loads(pickle.dumps(u1, protocol))
+            self.assertEqual((u2.key, u2.name, u2.lang), (u1.key, 'pickled', 'fr_FR'))
+            self.assertEqual(u2._dirty, u1._dirty)
+            self.assertTrue(u2.__class__ is u1.__class__)
+
+        # the state is stored by the field names
+        state = u1.__getstate__()
+        self.assertEqual((state['values']['name'], state['dirty']), ('pickled', ['lang']))
+
+    def test_model_database(self):
+        from kalapy.db.engines import get_database
+        self.assertEqual(Article._meta.database, 'default')
+        self.assertTrue(get_database(Article) is database)
+        self.assertTrue(get_database(Article()) is database)
+        def define():
+            class Revision(db.Model):
+                __database__ = 'no_such_database'
+        self.assertRaises(ValueError, define)
+
+        if settings.DATABASE_ENGINE == "gae":
+            return
+
+        # references to the models of other databases, the models are removed
+        # from the cache as the database is not configured
+        from kalapy.db.model import cache
+        settings.DATABASES['remote'] = {}
+        try:
+            class LocalTag(db.Model):
+                name = db.String()
+            class RemoteLog(db.Model):
+                tag = db.ManyToOne(LocalTag)
+                __database__ = 'remote'
+        finally:
+            del settings.DATABASES['remote']
+        try:
+            self.assertTrue('FOREIGN KEY' not in database.get_create_sql(RemoteLog))
+            q = RemoteLog.all().select_related('tag')
+            self.assertEqual(q._Query__qset.related, ())
+        finally:
+            for model in (LocalTag, RemoteLog):
+                meta = model._meta
+                cache.packages[meta.package].remove(meta.name)
+                del cache.aliases['%s:%s' % (meta.package, model.__name__)]
+                del cache.cache[meta.name]
+
     def test_model_save(self):
         u1 = User(name="some")
         key = u1.save()
@@ -161,6 +409,77 @@ class ModelTest(TestCase):
         res = User.get([k1, k2])
         self.assertTrue(isinstance(res, list))
 
+    def test_bulk_create(self):
+        n = User.all().count()
+        users = [User(name="bulk%d" % i) for i in range(1200)]
+        users[10].lang = 'en_EN'
+        keys = User.bulk_create(users)
+        self.assertEqual(keys, [u.key for u in users])
+        self.assertEqual(len(set(keys)), 1200)
+        self.assertEqual(User.all().count(), n + 1200)
+
+        database.identity_map.clear()
+        self.assertEqual(User.get(keys[10]).lang, 'en_EN')
+        self.assertEqual(User.get(keys[1199]).name, 'bulk1199')
+        self.assertFalse(users[0].is_dirty)
+
+        u = User(name="bulk_author")
+        articles = [Article(title="bulk", author=u) for i in range(3)]
+        Article.bulk_create(articles)
+        self.assertTrue(u.is_saved)
+        self.assertEqual(u.article_set.all().count(), 3)
+
+        self.assertRaises(ValueError, User.bulk_create, [users[0]])
+        self.assertRaises(TypeError, User.bulk_create, [Article(title="bulk")])
+
+    def test_bulk_save(self):
+        users = [User(name="bulk%d" % i) for i in range(10)]
+        User.bulk_create(users[:8])
+        for i, u in enumerate(users[:6]):
+            u.name = "saved%d" % i
+            if i % 2:
+                u.lang = 'fr_FR'
+        keys = User.bulk_save(users)
+        self.assertEqual(keys, [u.key for u in users])
+        self.assertFalse([u for u in users if u.is_dirty])
+
+        database.identity_map.clear()
+        res = User.get(keys)
+        self.assertEqual([u.name for u in res],
+            ["saved%d" % i for i in range(6)] + ["bulk%d" % i for i in range(6, 10)])
+        self.assertEqual([u.lang for u in res[:4]], [None, 'fr_FR', None, 'fr_FR'])
+
+    def test_identity_map(self):
+        u1 = User(name="some3")
+        u2 = User(name="some4")
+        k1 = u1.save()
+        k2 = u2.save()
+
+        # one instance per record
+        self.assertTrue(User.get(k1) is u1)
+        self.assertTrue(User.all().filter('name ==', 'some4').fetchone() is u2)
+        self.assertEqual(User.get([k2, k1]), [u2, u1])
+
+        database.identity_map.clear()
+        u3 = User.get(k1)
+        self.assertTrue(u3 is not u1)
+        self.assertTrue(u3 is User.get(k1))
+        self.assertTrue(u3 is User.get([k1])[0])
+
+        # stale after bulk update
+        User.all().filter('key ==', k1).update(name="some5")
+        self.assertEqual(User.get(k1).name, "some5")
+
+        u3.delete()
+        self.assertTrue(User.get(k1) is None)
+
+        # the referencing instances might be changed by the cascades
+        c1 = Cascade(user3=u2)
+        c1.save()
+        self.assertTrue(Cascade.get(c1.key) is c1)
+        User.all().filter('key ==', k2).delete()
+        self.assertTrue(Cascade.get(c1.key) is not c1)
+
     def test_model_all(self):
         u1 = User(name="some5")
         u1.save() # ensure at least one record exists
@@ -175,6 +494,16 @@ class ModelTest(TestCase):
         names = User.select('name').filter('name ==', u1.name).fetch(-1)
         self.assertTrue(names[0] == u1.name)
 
+        res = User.select('key', 'name').filter('name ==', u1.name).fetch(-1)
+        self.assertEqual(res, [(u1.key, u1.name)])
+
+        try:
+            User.select('no_such_field')
+        except AttributeError:
+            pass
+        else:
+            self.fail()
+
 
 class QueryTest(TestCase):
 
@@ -199,6 +528,283 @@ class QueryTest(TestCase):
 
         self.assertEqual(r1, r2)
 
+    def test_iter(self):
+        for n in list('abcdefghijklmnopqrstuvwxyz'):
+            u = User(name=n)
+            u.save()
+
+        q = User.all().order('-name')
+        self.assertEqual([o.name for o in q], list('zyxwvutsrqponmlkjihgfedcba'))
+
+        q = User.select('name').filter('name in', ['a', 'b', 'c']).order('name')
+        self.assertEqual(list(q), ['a', 'b', 'c'])
+
+    def test_fetch_page(self):
+        for n in list('abcdefghijklmnopqrstuvwxyz'):
+            u = User(name=n, lang='en_EN')
+            u.save()
+
+        q = User.select('name').order('-name')
+        r1, cursor = q.fetch_page(10)
+        r2, cursor = q.fetch_page(10, cursor)
+        r3, cursor = q.fetch_page(10, cursor)
+        self.assertEqual(r1 + r2 + r3, list('zyxwvutsrqponmlkjihgfedcba'))
+        self.assertTrue(cursor is None)
+
+        # no cursor after the last full page
+        r1, cursor = q.fetch_page(13)
+        r2, cursor = q.fetch_page(13, cursor)
+        self.assertEqual((len(r2), cursor), (13, None))
+
+        # same values of the order field, key is used as tie breaker
+        q = User.select('name').order('lang')
+        r1, cursor = q.fetch_page(13)
+        r2 = q.fetch_after(cursor, 13)
+        self.assertEqual(sorted(r1 + r2), list('abcdefghijklmnopqrstuvwxyz'))
+
+    def test_select_related(self):
+        u1 = User(name="u1")
+        u1.save()
+        a1 = Article(title="a1", author=u1)
+        a1.save()
+        a2 = Article(title="a2")
+        a2.save()
+        c1 = Comment(title="c1", article=a1, author=u1)
+        c1.save()
+
+        res = Article.all().select_related('author').order('title').fetch(-1)
+        self.assertEqual([a.title for a in res], ['a1', 'a2'])
+        self.assertEqual(res[0].author.key, u1.key)
+        self.assertEqual(res[0].author.name, 'u1')
+        self.assertTrue(res[1].author is None)
+
+        q = Comment.all().select_related('article.author', 'author') \
+                         .filter('title ==', 'c1')
+        c = q.fetchone()
+        self.assertEqual(c.article.key, a1.key)
+        self.assertEqual(c.article.author.name, 'u1')
+        self.assertEqual(c.author.key, u1.key)
+        self.assertTrue(c.parent is None)
+
+        try:
+            Comment.all().select_related('title')
+        except db.FieldError:
+            pass
+        else:
+            self.fail()
+
+    def test_hydrate(self):
+        import datetime, decimal
+        u1 = User(name="hydrate", dob=datetime.date(2001, 1, 1))
+        u1.save()
+        f1 = FieldType(decimal_value='1.5')
+        f1.save()
+        database.identity_map.clear()
+
+        u2 = User.all().filter('name ==', 'hydrate').fetchone()
+        self.assertTrue(u2.__class__ is u1.__class__)
+        self.assertEqual((u2.key, u2.dob, u2.notes), (u1.key, u1.dob, None))
+        self.assertFalse(u2.is_dirty)
+        self.assertTrue(u2 is User.get(u1.key))
+        self.assertEqual(FieldType.all().fetchone().decimal_value, decimal.Decimal('1.5'))
+        self.assertEqual(User.select('name', 'dob').filter('key ==', u1.key).fetch(-1),
+                         [('hydrate', datetime.date(2001, 1, 1))])
+
+    def test_inequalities(self):
+        u1 = User(name="ineq1", lang="en_EN")
+        u2 = User(name="ineq2", lang="fr_FR")
+        User.bulk_create([u1, u2])
+        q = User.all().filter('name >', 'ineq').filter('name <', 'ineq3') \
+                      .filter('lang >', 'en_EN')
+        self.assertEqual(q.fetch(-1), [u2])
+
+    def test_hydrate_extended(self):
+        FieldType(float_value=1.0).save()
+        database.identity_map.clear()
+        FieldType.all().fetch(-1)
+
+        # the model is restored afterwards, see Options._mutable
+        from kalapy.db.model import cache
+        meta = FieldType._meta
+        state = [(n, getattr(meta, n)) for n in meta._mutable]
+        try:
+            class FieldTypeEx(FieldType):
+                def double(self):
+                    return self.float_value * 2
+
+            database.identity_map.clear()
+            res = FieldType.all().fetch(-1)
+            self.assertTrue(isinstance(res[0], FieldTypeEx))
+            self.assertEqual(res[0].double(), 2.0)
+        finally:
+            for name, value in state:
+                setattr(meta, name, value)
+            meta.hydrators.clear()
+            cache.cache[meta.name] = FieldType
+            cache.aliases.pop('%s:FieldTypeEx' % meta.package, None)
+            database.identity_map.clear()
+
+    def test_filter_shared(self):
+        u1 = User(name="shared", lang="en_EN")
+        u1.save()
+        q = db.Q('name ==', 'shared')
+        q1 = User.all().filter(q)
+        q2 = q1.filter('lang ==', 'fr_FR').order('-name')
+        q3 = q1.filter(q | db.Q('name ==', 'other'))
+        self.assertEqual(q.items, (('name', '==', 'shared'),))
+        self.assertEqual(q1.fetch(-1), [u1])
+        self.assertEqual(q2.fetch(-1), [])
+        self.assertEqual(q3.fetch(-1), [u1])
+        self.assertEqual(db.Q('name IN', ['a']).items, (('name', 'in', ['a']),))
+
+    def test_optimize(self):
+        from kalapy.db.query import QSet
+
+        def optimize(*qs):
+            qset = QSet(User)
+            for q in qs:
+                qset = qset.filter(q)
+            qset = qset.optimize()
+            return qset and [list(q.items) for q in qset]
+
+        self.assertEqual(optimize(db.Q('name ==', 'a') | db.Q('name ==', 'b') | \
+                                  db.Q('name in', ['b', 'c']) | db.Q('lang ==', 'x')),
+                         [[('name', 'in', ['a', 'b', 'c']), ('lang', '==', 'x')]])
+        self.assertEqual(optimize(db.Q('name in', ['a', 'b']), db.Q('name ==', 'b'),
+                                  db.Q('lang >', 'x'), db.Q('lang >', 'x')),
+                         [[('name', '==', 'b')], [('lang', '>', 'x')]])
+        self.assertEqual(optimize(db.Q('name ==', 'a'), db.Q('name ==', 'b')), None)
+        self.assertEqual(optimize(db.Q('key in', [])), None)
+        self.assertEqual(optimize(db.Q('key not in', []), db.Q('name in', ['a'])),
+                         [[('name', '==', 'a')]])
+
+        u1 = User(name="optimize")
+        u1.save()
+        q = User.all().filter('name ==', 'optimize')
+        self.assertEqual(q.count(), 1)
+        self.assertEqual(q.filter('name ==', 'other').count(), 0)
+        self.assertEqual(q.filter('key in', []).fetch(-1), [])
+        self.assertEqual(q.filter('key in', []).delete(), 0)
+        self.assertEqual(q.filter(db.Q('name ==', 'x') | db.Q('name ==', 'optimize')).fetch(-1), [u1])
+
+    def test_nocase_eq(self):
+        u1 = User(name="Nocase")
+        u1.save()
+        self.assertEqual(User.all().filter('name =', 'nOCASE').fetch(-1), [u1])
+        self.assertEqual(User.all().filter('name ==', 'nOCASE').fetch(-1), [])
+        self.assertEqual(User.all().filter('name =', 'noca%').fetch(-1), [])
+        self.assertEqual(User.all().filter('key =', u1.key).fetch(-1), [u1])
+
+    def test_large_in(self):
+        users = [User(name="large%d" % i) for i in range(1200)]
+        keys = User.bulk_create(users)
+        missing = max(keys) + 1
+
+        q = User.all().filter('key in', keys + [missing])
+        self.assertEqual(q.count(), 1200)
+        self.assertEqual(q.order('-name').fetch(2), [users[999], users[998]])
+        self.assertEqual(User.all().filter('name ==', 'large5')
+                             .filter('key not in', keys[:1000]).fetch(-1), [])
+
+        database.identity_map.clear()
+        res = User.get([missing] + list(reversed(keys)))
+        self.assertEqual(res[0], None)
+        self.assertEqual([u.name for u in res[1:]], [u.name for u in reversed(users)])
+        self.assertEqual(q.delete(), 1200)
+
+    def test_large_in_split(self):
+        users = [User(name="split%d" % i) for i in range(1200)]
+        keys = User.bulk_create(users)
+        other = User(name="other")
+        other.save()
+
+        q = User.all().filter(db.Q('key in', keys + keys[:10]) | db.Q('name ==', 'other'))
+        self.assertEqual(q.count(), 1201)
+        self.assertEqual(q.order('-name').fetch(2, 1), [users[998], users[997]])
+        page, cursor = q.order('name').fetch_page(1000)
+        self.assertEqual(len(page), 1000)
+        page, cursor = q.order('name').fetch_page(1000, cursor)
+        self.assertEqual((page[-1], cursor), (users[999], None))
+        self.assertEqual(q.update(lang='fr_FR'), 1201)
+        self.assertEqual(q.delete(), 1201)
+
+    def test_large_in_select(self):
+        users = [User(name="select%d" % i, lang=["en_EN", "fr_FR", "de_DE"][i % 3]) for i in range(20)]
+        keys = User.bulk_create(users)
+        keys = keys + range(-1000, -1)
+
+        q = User.select('name').filter('key in', keys)
+        self.assertEqual(sorted(q.fetch(-1)), sorted([u.name for u in users]))
+        names = [u.name for u in sorted(users, key=lambda u: (u.lang, u.key))]
+        self.assertEqual(q.order('lang').fetch(-1), names)
+        page, cursor = q.order('lang').fetch_page(15)
+        self.assertEqual(page + q.order('lang').fetch_after(cursor, 15), names)
+
+    def test_large_in_transaction(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        from kalapy.db.engines import Database
+        u = User(name="uncommitted")
+        u.save()
+        User.all().filter('key in', [u.key] + range(-1000, -1)).count()
+
+        # the pending changes are not committed by the large in filters
+        other = Database(name=settings.DATABASE_NAME,
+                         host=settings.DATABASE_HOST,
+                         port=settings.DATABASE_PORT,
+                         user=settings.DATABASE_USER,
+                         password=settings.DATABASE_PASSWORD)
+        try:
+            self.assertEqual(other.fetch_record(User, u.key), None)
+        finally:
+            other.close()
+
+    def test_prefetch(self):
+        u1 = User(name="u1")
+        u2 = User(name="u2")
+        u1.address_set.add(Address(city="a1"),
+                           Address(city="a2"))
+        u2.save()
+        g1 = Group(name="g1")
+        g1.members.add(u1)
+
+        res = User.all().filter('name in', ['u1', 'u2']).order('name') \
+                  .prefetch('address_set', 'groups').fetch(-1)
+        self.assertEqual(sorted(res[0]._prefetched), ['address_set', 'groups'])
+
+        q = res[0].address_set.all().order('-city')
+        self.assertEqual([a.city for a in q], ['a2', 'a1'])
+        self.assertEqual(q.count(), 2)
+        self.assertTrue(q.fetchone().user is res[0])
+        self.assertEqual(q.filter('city ==', 'a1').count(), 1)
+        self.assertEqual(res[1].address_set.all().fetch(-1), [])
+        self.assertEqual([g.key for g in res[0].groups.all()], [g1.key])
+        self.assertEqual(res[1].groups.all().count(), 0)
+
+        res[1].address_set.add(Address(city="a3"))
+        self.assertEqual(res[1].address_set.all().count(), 1)
+
+        try:
+            User.all().prefetch('name')
+        except db.FieldError:
+            pass
+        else:
+            self.fail()
+
+    def test_prefetch_loaded(self):
+        u1 = User(name="u1")
+        a1 = Address(city="a1", user=u1)
+        a1.save()
+        g1 = Group(name="g1")
+        g1.members.add(u1)
+        links = User._meta.virtual_fields['groups'].m2m.all().fetch(-1)
+
+        # the children kept in the identity map hold the parent instance
+        res = User.all().filter('name ==', 'u1') \
+                  .prefetch('address_set', 'groups').fetch(-1)
+        self.assertEqual(res[0].address_set.all().fetch(-1), [a1])
+        self.assertEqual([g.key for g in res[0].groups.all()], [g1.key])
+
     def test_delete(self):
 
         for n in list('abcdefghijklmnopqrstuvwxyz'):
@@ -207,7 +813,7 @@ class QueryTest(TestCase):
 
         n1 = User.all().count()
         q = User.all().filter('name in', ['a', 'b', 'c'])
-        q.delete()
+        self.assertEqual(q.delete(), 3)
         n2 = User.all().count()
 
         self.assertTrue(n2 == n1 - 3)
@@ -228,8 +834,8 @@ class QueryTest(TestCase):
         q1 = q.filter('name in', ['a', 'b', 'c'])
         q2 = q.filter('name in', ['d', 'e', 'f'])
 
-        q1.update(lang='en_EN')
-        q2.update(lang='fr_FR')
+        self.assertEqual(q1.update(lang='en_EN'), 3)
+        self.assertEqual(q2.update(lang='fr_FR'), 3)
 
         n1 = q.filter('lang ==', 'en_EN').count()
         n2 = q.filter('lang ==', 'fr_FR').count()
@@ -237,6 +843,13 @@ class QueryTest(TestCase):
         self.assertTrue(n1 == 3)
         self.assertTrue(n2 == 3)
 
+        try:
+            q1.update(lang='en_IN')
+        except db.ValidationError:
+            pass
+        else:
+            self.fail()
+
 
 class FieldTest(TestCase):
 
@@ -387,7 +1000,27 @@ class FieldTest(TestCase):
         # get article by author some with title story1
         a = u1.article_set.all().filter('title =', 'story1').fetchone()
         assert a.title == 'story1'
+        assert a is a1
+
+        # test lazy loading
+        database.identity_map.clear()
+        a = u1.article_set.all().filter('title =', 'story1').fetchone()
+        assert a is not a1
+        assert a._values[Article.author._index] == u1.key
+        assert a.author_key == u1.key
         assert a.author.key == u1.key
+        assert isinstance(a._values[Article.author._index], User)
+        assert a.author_key == u1.key
+
+        a.author = None
+        assert a.author_key is None
+
+        try:
+            a.author_key = u1.key
+        except AttributeError:
+            pass
+        else:
+            self.fail()
 
     def test_OneToOne(self):
         u1 = User(name="some")
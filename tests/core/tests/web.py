@@ -49,6 +49,12 @@ class CoreTest(TestCase):
         else:
             assert 'Expected ValueError'
 
+    def test_readonly(self):
+        c = self.client
+        assert c.get('/readonly').data == 'True'
+        assert c.get('/readwrite').data == 'False'
+        assert c.post('/readwrite').data == 'False'
+
     def test_url_generation(self):
         assert web.url_for('response', kind="no thing", extra='test x') \
             == '/response/no%20thing?extra=test+x'
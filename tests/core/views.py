@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from kalapy import web
 from kalapy.web import request
+from kalapy.db.engines import database
 
 @web.route('/')
 def index():
@@ -41,3 +42,11 @@ def middleware(action):
         1/0
     return action
 
+
+@web.route('/readonly', readonly=True)
+def readonly():
+    return str(database.readonly)
+
+@web.route('/readwrite', methods=('GET', 'POST'))
+def readwrite():
+    return str(database.readonly)